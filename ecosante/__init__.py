@@ -30,6 +30,36 @@ def configure_celery(flask_app):
     celery.Task = ContextTask
 
 
+def celery_urls(database_uri):
+    """Broker et backend de résultats, Postgres par défaut. REDIS_URL peut
+    être fourni par l’hébergeur sans que Redis soit voulu pour Celery :
+    le profil Redis se demande avec CELERY_PROFILE=redis"""
+    redis_url = os.getenv('REDIS_URL') if os.getenv('CELERY_PROFILE') == 'redis' else None
+    return {
+        'CELERY_RESULT_BACKEND': os.getenv('CELERY_RESULT_BACKEND') or redis_url or f"db+{database_uri}",
+        'CELERY_BROKER_URL': os.getenv('CELERY_BROKER_URL') or redis_url or f"sqla+{database_uri}",
+    }
+
+
+def redis_celery_config():
+    """Profil Redis pour Celery : connexions réutilisées depuis un pool
+    et résultats expirés, plutôt que des tables Postgres partagées avec l’app"""
+    max_connections = int(os.getenv('REDIS_MAX_CONNECTIONS', 20))
+    return {
+        'CELERY_BROKER_POOL_LIMIT': int(os.getenv('CELERY_BROKER_POOL_LIMIT', 10)),
+        'CELERY_BROKER_TRANSPORT_OPTIONS': {
+            'max_connections': max_connections,
+            # L’envoi de la newsletter peut dépasser l’heure par défaut,
+            # au-delà de laquelle la tâche serait redistribuée
+            'visibility_timeout': int(os.getenv('CELERY_VISIBILITY_TIMEOUT', 6*3600)),
+        },
+        'CELERY_REDIS_MAX_CONNECTIONS': max_connections,
+        'CELERY_REDIS_SOCKET_KEEPALIVE': True,
+        'CELERY_REDIS_RETRY_ON_TIMEOUT': True,
+        'CELERY_RESULT_EXPIRES': int(os.getenv('CELERY_RESULT_EXPIRES', 24*3600)),
+    }
+
+
 def create_app(testing=False):
     app = Flask(
         __name__,
@@ -41,8 +71,9 @@ def create_app(testing=False):
     app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
     app.config['SECRET_KEY'] = os.getenv('SECRET_KEY')
     app.config['ASSETS_DEBUG'] = True
-    app.config['CELERY_RESULT_BACKEND'] = os.getenv('CELERY_RESULT_BACKEND') or f"db+{app.config['SQLALCHEMY_DATABASE_URI']}"
-    app.config['CELERY_BROKER_URL'] = os.getenv('CELERY_BROKER_URL') or f"sqla+{app.config['SQLALCHEMY_DATABASE_URI']}"
+    app.config.update(celery_urls(app.config['SQLALCHEMY_DATABASE_URI']))
+    if any(app.config[k].startswith('redis') for k in ['CELERY_RESULT_BACKEND', 'CELERY_BROKER_URL']):
+        app.config.update(redis_celery_config())
     app.config['TESTING'] = testing
     app.config['SERVER_NAME'] = os.getenv("SERVER_NAME")
 
@@ -54,12 +85,13 @@ def create_app(testing=False):
     celery = configure_celery(app)
 
     with app.app_context():
-        from .inscription import models, blueprint as inscription_bp, tasks
+        from .inscription import models, commands, blueprint as inscription_bp, tasks
         from .recommandations import models, commands, blueprint as recommandation_bp
         from .avis import models, commands, blueprint as avis_bp
-        from .stats import blueprint as stats_bp
-        from .newsletter import blueprint as newsletter_bp, tasks
+        from .stats import models, commands, blueprint as stats_bp, tasks
+        from .newsletter import blueprint as newsletter_bp, tasks, commands
         from .pages import blueprint as pages_bp
+        from .tasks import commands
         from .utils.funcs import oxford_comma, display_check
 
         app.register_blueprint(inscription_bp.bp)
@@ -0,0 +1,36 @@
+from ecosante.extensions import db
+from ecosante.inscription import communes
+from ecosante.inscription.models import Inscription
+from flask import current_app
+from time import perf_counter
+
+
+def benchmark_deuxieme_etape(n=200):
+    """Chronomètre n mises à jour de la commune d’une inscription de test
+    par /inscription/<uid>/, en alternant entre deux communes de l’index
+    local. L’inscription est supprimée ensuite"""
+    insees = list(communes.get_index().communes)[:2]
+    if len(insees) < 2:
+        raise ValueError("Il faut au moins deux communes dans l’index local (flask update-communes)")
+    inscription = Inscription(mail=f'benchmark-{perf_counter()}@recosante.beta.gouv.fr')
+    db.session.add(inscription)
+    db.session.commit()
+    client = current_app.test_client()
+    durations = []
+    try:
+        for i in range(n):
+            start = perf_counter()
+            response = client.post(f'/inscription/{inscription.uid}/', json={'ville_insee': insees[i % 2]})
+            durations.append(perf_counter() - start)
+            if response.status_code != 200:
+                raise ValueError(f"Réponse {response.status_code} : {response.get_data(as_text=True)}")
+    finally:
+        db.session.rollback()
+        Inscription.query.filter_by(id=inscription.id).delete()
+        db.session.commit()
+    durations.sort()
+    return {
+        "requetes": n,
+        "p50": durations[int(0.5*(n - 1))],
+        "p95": durations[int(0.95*(n - 1))],
+    }
@@ -44,15 +44,14 @@ def deuxieme_etape(uid):
         if not inscription:
             abort(404)
         if form.validate_on_submit():
-            for fieldname in form._fields.keys():
-                if (request.form and fieldname in request.form.keys()) or (request.json and fieldname in request.json.keys()):
-                    setattr(inscription, fieldname, getattr(form, fieldname).data)
-            db.session.add(inscription)
-            db.session.commit()
-            inscription = db.session.query(Inscription).filter_by(uid=uid).first()
+            changed = inscription.update({
+                fieldname: getattr(form, fieldname).data
+                for fieldname in form._fields.keys()
+                if (request.form and fieldname in request.form.keys()) or (request.json and fieldname in request.json.keys())
+            })
         else:
             return jsonify(form.errors), 400
-    return {
+    response = {
         **{
             k: getattr(inscription, k)
             for k in form._fields.keys()
@@ -62,6 +61,11 @@ def deuxieme_etape(uid):
             "ville_codes_postaux": inscription.ville_codes_postaux
         }
     }
+    # La réponse est construite avant le commit, qui expire l’inscription :
+    # pas de relecture
+    if request.method == 'POST' and changed:
+        db.session.commit()
+    return response
 
 @bp.route('/<uid>/_confirm', methods=['GET'], strict_slashes=False)
 @cross_origin(origins='*')
@@ -76,15 +80,17 @@ def confirm(uid):
     return jsonify({"result": "ok"})
 
 
+# Évènements SIB (webhooks marketing et transactionnels) qui blacklistent le contact
+BLACKLIST_EVENTS = {'unsubscribe', 'unsubscribed', 'hardBounce', 'hard_bounce', 'spam'}
+
 @bp.route('<secret_slug>/user_unsubscription', methods=['POST'])
 @webhook_capability_url
 def user_unsubscription(secret_slug):
-    mail = request.json['email']
-    user = Inscription.query.filter_by(mail=mail).first()
-    if not user:
-        celery.send_task("ecosante.inscription.tasks.send_unsubscribe.send_unsubscribe_errorsend_unsubscribe_error", (mail,))
-    else:
-        user.unsubscribe()
+    # Un évènement ou une liste d’évènements du webhook SIB ; sans type,
+    # l’évènement est une désinscription
+    events = request.json if isinstance(request.json, list) else [request.json]
+    mails = [e['email'] for e in events if e.get('event', 'unsubscribed') in BLACKLIST_EVENTS]
+    Inscription.bulk_unsubscribe(mails, notify_unknown=True)
     return jsonify(request.json)
 
 @bp.route('<secret_slug>/export')
@@ -111,7 +117,12 @@ def liste():
 
 @bp.route('/geojson')
 def geojson():
-    return jsonify(Inscription.export_geojson())
+    body, etag = Inscription.cached_geojson()
+    response = Response(body, mimetype="application/json")
+    response.set_etag(etag)
+    response.cache_control.public = True
+    response.cache_control.max_age = 60
+    return response.make_conditional(request)
 
 
 @bp.route('/changement')
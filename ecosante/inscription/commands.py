@@ -0,0 +1,37 @@
+from flask import current_app
+import click
+from . import communes
+from .models import Inscription
+from .benchmark import benchmark_deuxieme_etape
+
+@current_app.cli.command('update-communes')
+@click.option('--path', default=communes.COMMUNES_PATH)
+@click.option('--version', default=None)
+def update_communes(path, version):
+    current_app.logger.info("Téléchargement des communes depuis geo.api.gouv.fr")
+    liste = communes.fetch_all()
+    communes.CommuneIndex.write(liste, path, version)
+    current_app.logger.info(f"{len(liste)} communes écrites dans {path}")
+
+
+@current_app.cli.command('refresh-cache-communes')
+@click.option('--all', 'all_', is_flag=True, help="Toutes les inscriptions, pas seulement celles au cache manquant ou incomplet")
+@click.option('--batch-size', default=500)
+def refresh_cache_communes(all_, batch_size):
+    report = Inscription.refresh_cache_api_commune(all_=all_, batch_size=batch_size)
+    click.echo(
+        f"{report['inscriptions']} inscriptions mises à jour, "
+        f"{report['communes']} communes en {report['duree']:.1f}s"
+    )
+    if report['communes_non_trouvees']:
+        click.echo(f"Communes non trouvées : {', '.join(report['communes_non_trouvees'])}")
+
+
+@current_app.cli.command('benchmark-deuxieme-etape')
+@click.option('--n', default=200)
+def benchmark_deuxieme_etape_command(n):
+    report = benchmark_deuxieme_etape(n)
+    click.echo(
+        f"{report['requetes']} requêtes : p50 {report['p50']*1000:.1f}ms, "
+        f"p95 {report['p95']*1000:.1f}ms"
+    )
@@ -0,0 +1,99 @@
+from datetime import date
+from threading import Lock
+from types import MappingProxyType
+import gzip
+import json
+import os
+import requests
+
+GEO_API_URL = 'https://geo.api.gouv.fr/communes'
+FIELDS = "nom,code,centre,region,codesPostaux,departement"
+COMMUNES_PATH = os.getenv(
+    'COMMUNES_PATH',
+    os.path.join(os.path.dirname(__file__), 'data', 'communes.json.gz')
+)
+
+
+class CommuneIndex:
+    """Index en lecture seule INSEE -> commune, au format de geo.api.gouv.fr
+    (nom, code, centre, region, codesPostaux, departement)"""
+
+    def __init__(self, communes, version=None):
+        self.communes = MappingProxyType(communes)
+        self.version = version
+
+    def __len__(self):
+        return len(self.communes)
+
+    def __contains__(self, insee):
+        return insee in self.communes
+
+    def get(self, insee):
+        commune = self.communes.get(insee)
+        # Copie : le résultat finit dans une colonne JSON modifiable
+        return dict(commune) if commune else None
+
+    @classmethod
+    def load(cls, path=COMMUNES_PATH):
+        if not os.path.exists(path):
+            return cls({})
+        with gzip.open(path, 'rt', encoding='utf-8') as f:
+            data = json.load(f)
+        return cls(data['communes'], data.get('version'))
+
+    @staticmethod
+    def write(communes, path=COMMUNES_PATH, version=None):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with gzip.open(path, 'wt', encoding='utf-8') as f:
+            json.dump(
+                {
+                    "version": version or str(date.today()),
+                    "communes": {c['code']: c for c in communes}
+                },
+                f,
+                ensure_ascii=False,
+                sort_keys=True
+            )
+
+
+_index = None
+_index_lock = Lock()
+
+def get_index() -> CommuneIndex:
+    global _index
+    if _index is None:
+        with _index_lock:
+            if _index is None:
+                _index = CommuneIndex.load()
+    return _index
+
+def get(insee):
+    if not insee:
+        return None
+    return get_index().get(insee)
+
+
+def fetch(insee):
+    """Appel à geo.api.gouv.fr, à n’utiliser qu’en dehors des chemins chauds"""
+    r = requests.get(f'{GEO_API_URL}/{insee}',
+        params={
+            "fields": FIELDS,
+            "format": "json",
+            "geometry": "centre"
+        }
+    )
+    if not r.ok:
+        return None
+    return r.json()
+
+def fetch_all():
+    r = requests.get(GEO_API_URL,
+        params={
+            "fields": FIELDS,
+            "format": "json",
+            "geometry": "centre",
+            "type": "commune-actuelle,arrondissement-municipal"
+        }
+    )
+    r.raise_for_status()
+    return r.json()
@@ -1,8 +1,8 @@
-import requests
 from wtforms import ValidationError, validators, HiddenField
 from wtforms.fields.core import SelectField
 from wtforms.fields.html5 import EmailField
 from ecosante.utils.form import BaseForm, MultiCheckboxField
+from ecosante.inscription import communes
 
 class FormPremiereEtape(BaseForm):
     class Meta:
@@ -38,8 +38,11 @@ class FormDeuxiemeEtape(BaseForm):
     enfants = SelectField(choices=['oui', 'non', 'aucun', None], coerce=lambda v: None if v is None else str(v))
 
     def validate_ville_insee(form, field):
-        r = requests.get(f'https://geo.api.gouv.fr/communes/{field.data}')
-        try:
-            r.raise_for_status()
-        except requests.HTTPError as e:
+        if not field.data:
+            return
+        index = communes.get_index()
+        # geo.api.gouv.fr n’est appelé que si l’index local n’a pas été généré
+        if field.data in index:
+            return
+        if len(index) or not communes.fetch(field.data):
             raise ValidationError("Unable to get ville")
@@ -1,18 +1,28 @@
 from ecosante.extensions import db
-from ecosante.utils.funcs import generate_line
+from ecosante.utils.funcs import generate_line, generate_lines
+from ecosante.inscription import communes
 from sqlalchemy.dialects import postgresql
 from sqlalchemy import func
 from datetime import (
     date,
+    datetime,
     timedelta
 )
 from dataclasses import dataclass
 from typing import List
-import requests
 from datetime import date
-from sqlalchemy import text, or_
+from sqlalchemy import text, or_, case, cast, literal, event
+from sqlalchemy.orm import Session
 from sqlalchemy.ext.hybrid import hybrid_property
 from sqlalchemy.orm.attributes import flag_modified
+from flask import current_app
+from time import perf_counter
+from hashlib import sha1
+import json
+import os
+from ecosante.utils.cache import TTLCache
+
+CACHE_API_COMMUNE_KEYS = ['nom', 'centre', 'region', 'codesPostaux', 'departement']
 
 @dataclass
 class Inscription(db.Model):
@@ -23,7 +33,8 @@ class Inscription(db.Model):
     id: int = db.Column(db.Integer, primary_key=True)
     uid: str = db.Column(
         db.String(),
-        server_default=text("generate_random_id('public', 'inscription', 'uid', 8)")
+        server_default=text("generate_random_id('public', 'inscription', 'uid', 8)"),
+        unique=True
     )
     ville_entree: str = db.Column(db.String)
     ville_name: str = db.Column(db.String)
@@ -135,28 +146,23 @@ class Inscription(db.Model):
     def set_cache_api_commune(self):
         if not self.ville_insee:
             return
-        r = requests.get(f'https://geo.api.gouv.fr/communes/{self.ville_insee}',
-            params={
-                "fields": "nom,centre,region,codesPostaux,departement",
-                "format": "json",
-                "geometry": "centre"
-            }
-        )
-        self._cache_api_commune = r.json()
-        db.session.add(self)
-        db.session.commit()
+        self._cache_api_commune = communes.get(self.ville_insee) or communes.fetch(self.ville_insee)
 
     @property
     def cache_api_commune(self):
         if not self.ville_insee:
             return {}
         if not self._cache_api_commune:
-            self.set_cache_api_commune()
-        return self._cache_api_commune
+            self._cache_api_commune = communes.get(self.ville_insee)
+            if not self._cache_api_commune and not communes.get_index():
+                # Index local absent : on se rabat sur geo.api.gouv.fr
+                self._cache_api_commune = communes.fetch(self.ville_insee)
+        return self._cache_api_commune or {}
 
     def cache_api_commune_get(self, key, default_value=None):
         if self._cache_api_commune and not key in self._cache_api_commune:
-            self._cache_api_commune = None
+            # Cache incomplet, on le complète avec l’index local
+            self._cache_api_commune = communes.get(self.ville_insee) or self._cache_api_commune
         return self.cache_api_commune.get(key, default_value)
 
     @hybrid_property
@@ -212,6 +218,15 @@ class Inscription(db.Model):
             .filter(NewsletterDB.id.in_(query_sent_nl))\
             .all()
 
+    def update(self, values):
+        """Ne modifie que les champs dont la valeur change : le flush ne fait
+        qu’un UPDATE de ces colonnes, et la commune n’est cherchée que si la
+        ville change. Renvoie les noms des champs modifiés"""
+        changed = [k for k, v in values.items() if getattr(self, k) != v]
+        for k in changed:
+            setattr(self, k, values[k])
+        return changed
+
     @classmethod
     def active_query(cls):
         return db.session.query(cls)\
@@ -219,33 +234,96 @@ class Inscription(db.Model):
             .filter(Inscription.ville_insee.isnot(None))
 
     def unsubscribe(self):
-        from ecosante.inscription.tasks.send_unsubscribe import send_unsubscribe, send_unsubscribe_error
+        from ecosante.inscription.tasks.send_unsubscribe import send_unsubscribe_digest
         self.deactivation_date = date.today()
         db.session.add(self)
         db.session.commit()
-        send_unsubscribe.apply_async(
-            (self.mail,),
-            link_error=send_unsubscribe_error.s()
+        send_unsubscribe_digest.delay([self.mail])
+
+    @classmethod
+    def bulk_unsubscribe(cls, mails, notify_unknown=False):
+        """Désinscrit les inscriptions actives de `mails` en une seule requête
+        UPDATE ... RETURNING, puis envoie un seul mail récapitulatif.
+        Renvoie les adresses désinscrites et celles sans inscription"""
+        from ecosante.inscription.tasks.send_unsubscribe import send_unsubscribe_digest
+        mails = {mail for mail in mails if mail}
+        if not mails:
+            return [], []
+        today = date.today()
+        desinscrites = sorted(
+            mail for (mail,) in db.session.execute(
+                cls.__table__.update()\
+                    .where(cls.mail.in_(mails))\
+                    .where(or_(cls.deactivation_date == None, cls.deactivation_date > today))\
+                    .values(deactivation_date=today)\
+                    .returning(cls.mail)
+            )
         )
+        restantes = mails - set(desinscrites)
+        connues = {
+            mail for (mail,) in db.session.query(cls.mail).filter(cls.mail.in_(restantes))
+        } if restantes else set()
+        db.session.commit()
+        # La mise à jour ne passe pas par l’ORM et ne déclenche pas les évènements after_update
+        cls.geojson_cache.clear()
+        inconnues = sorted(restantes - connues)
+        if desinscrites or (notify_unknown and inconnues):
+            send_unsubscribe_digest.delay(desinscrites, inconnues if notify_unknown else [])
+        return desinscrites, inconnues
 
     @classmethod
     def generate_csv(cls):
-        yield generate_line([
-            'region',
-            'ville',
-            'deplacement',
-            'activites',
-            'pathologie_respiratoire',
-            'allergie_pollens',
-            'enfants',
-            'diffusion',
-            'mail',
-            'frequence',
-            'date_inscription',
-            'deactivation_date'
-        ])
-        for inscription in cls.active_query().all():
-            yield inscription.csv_line()
+        rows = cls.active_query()\
+            .with_entities(
+                cls._ville_insee.label("ville_insee"),
+                cls._cache_api_commune.label("cache_api_commune"),
+                cls.deplacement,
+                cls.activites,
+                cls.population,
+                cls.enfants,
+                cls.diffusion,
+                cls.mail,
+                cls.frequence,
+                cls.date_inscription,
+                cls.deactivation_date
+            )\
+            .yield_per(1000)
+
+        def lines():
+            yield [
+                'region',
+                'ville',
+                'deplacement',
+                'activites',
+                'pathologie_respiratoire',
+                'allergie_pollens',
+                'enfants',
+                'diffusion',
+                'mail',
+                'frequence',
+                'date_inscription',
+                'deactivation_date'
+            ]
+            for row in rows:
+                commune = row.cache_api_commune
+                if not commune or not 'region' in commune or not 'nom' in commune:
+                    commune = communes.get(row.ville_insee) or commune or {}
+                population = row.population if type(row.population) == list else []
+                yield [
+                    commune.get('region', {}).get('nom'),
+                    commune.get('nom'),
+                    row.deplacement,
+                    row.activites,
+                    "pathologie_respiratoire" in population,
+                    "allergie_pollens" in population,
+                    row.enfants,
+                    row.diffusion,
+                    row.mail,
+                    row.frequence,
+                    row.date_inscription,
+                    row.deactivation_date
+                ]
+        return generate_lines(lines())
     
     def csv_line(self):
         return generate_line([
@@ -264,18 +342,38 @@ class Inscription(db.Model):
         ])
 
     @classmethod
-    def export_geojson(cls):
-        return {
-            "type": "FeatureCollection",
-            "features": [
-                {
-                    "type": "Feature",
-                    "properties": [],
-                    "geometry": i.ville_centre
-                }
-                for i in cls.active_query().all()
-            ]
-        }
+    def generate_geojson(cls):
+        """Un point par centre de commune, avec le nombre d’inscrits"""
+        rows = cls.active_query()\
+            .with_entities(
+                cls._ville_insee,
+                func.count(cls.id),
+                func.min(cast(cls._cache_api_commune['centre'], db.Text))
+            )\
+            .group_by(cls._ville_insee)
+        points = dict()
+        for insee, count, centre in rows:
+            geometry = (json.loads(centre) if centre else None) or (communes.get(insee) or {}).get('centre')
+            if not geometry:
+                continue
+            key = json.dumps(geometry, sort_keys=True)
+            points[key] = points.get(key, 0) + count
+        yield '{"type": "FeatureCollection", "features": ['
+        for i, (geometry, count) in enumerate(points.items()):
+            yield f'{"," if i else ""}{{"type": "Feature", "properties": {{"count": {count}}}, "geometry": {geometry}}}'
+        yield ']}'
+
+    geojson_cache = TTLCache(int(os.getenv('GEOJSON_CACHE_TTL', 600)))
+
+    @classmethod
+    def cached_geojson(cls):
+        """(GeoJSON sérialisé, ETag), recalculés quand une inscription change
+        ou au plus tard après GEOJSON_CACHE_TTL secondes"""
+        cached = cls.geojson_cache.get('geojson')
+        if not cached:
+            body = "".join(cls.generate_geojson())
+            cached = cls.geojson_cache.set('geojson', (body, sha1(body.encode()).hexdigest()))
+        return cached
 
     @classmethod
     def query_inactive_accounts(cls):
@@ -291,4 +389,89 @@ class Inscription(db.Model):
             .filter(cls.mail != None)\
             .update({"mail": None})
         db.session.commit()
-        return r
\ No newline at end of file
+        return r
+
+    @classmethod
+    def query_stale_cache_api_commune(cls):
+        cache = cast(cls._cache_api_commune, postgresql.JSONB)
+        return db.session.query(cls)\
+            .filter(cls.ville_insee.isnot(None))\
+            .filter(or_(
+                cls._cache_api_commune == None,
+                ~cache.has_all(postgresql.array(CACHE_API_COMMUNE_KEYS))
+            ))
+
+    @classmethod
+    def refresh_cache_api_commune(cls, all_=False, batch_size=500):
+        """Remplit le cache commune des inscriptions où il manque ou est
+        incomplet (toutes si `all_`), une résolution par code INSEE et
+        un seul UPDATE par lot de communes"""
+        start = perf_counter()
+        query = db.session.query(cls) if all_ else cls.query_stale_cache_api_commune()
+        insees = [
+            v[0] for v in
+            query.filter(cls.ville_insee.isnot(None))\
+                .with_entities(cls.ville_insee)\
+                .distinct()\
+                .all()
+        ]
+        nb_rows = 0
+        unresolved = []
+        for i in range(0, len(insees), batch_size):
+            resolved = dict()
+            for insee in insees[i:i+batch_size]:
+                commune = communes.get(insee) or communes.fetch(insee)
+                if commune:
+                    resolved[insee] = commune
+                else:
+                    unresolved.append(insee)
+            if not resolved:
+                continue
+            nb_rows += query\
+                .filter(cls.ville_insee.in_(list(resolved.keys())))\
+                .update(
+                    {
+                        cls._cache_api_commune: case(
+                            {insee: cast(literal(commune, db.JSON), db.JSON) for insee, commune in resolved.items()},
+                            value=cls._ville_insee
+                        )
+                    },
+                    synchronize_session=False
+                )
+            db.session.commit()
+        report = {
+            "communes": len(insees),
+            "communes_non_trouvees": unresolved,
+            "inscriptions": nb_rows,
+            "duree": perf_counter() - start
+        }
+        current_app.logger.info(
+            f"Cache commune mis à jour pour {nb_rows} inscriptions "
+            f"({len(insees)} communes, {len(unresolved)} non trouvées) en {report['duree']:.1f}s"
+        )
+        return report
+
+
+@dataclass
+class SyncState(db.Model):
+    """Point de reprise d’une synchronisation incrémentale avec un service externe"""
+    name: str = db.Column(db.String, primary_key=True)
+    synced_at: datetime = db.Column(db.DateTime(timezone=True))
+
+    @classmethod
+    def get(cls, name):
+        state = cls.query.get(name)
+        if not state:
+            state = cls(name=name)
+            db.session.add(state)
+        return state
+
+
+for event_name in ['after_insert', 'after_update', 'after_delete']:
+    event.listen(Inscription, event_name, Inscription.geojson_cache.clear)
+
+@event.listens_for(Session, 'after_bulk_update')
+@event.listens_for(Session, 'after_bulk_delete')
+def clear_inscription_caches(context):
+    if context.mapper.class_ is Inscription:
+        Inscription.geojson_cache.clear()
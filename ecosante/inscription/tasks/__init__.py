@@ -1,5 +1,5 @@
 from .send_success_email import send_success_email #noqa
-from .send_unsubscribe import send_unsubscribe, send_unsubscribe_error #noqa
+from .send_unsubscribe import send_unsubscribe, send_unsubscribe_error, send_unsubscribe_digest #noqa
 
 from ecosante.extensions import celery
 from ecosante.inscription.models import Inscription
@@ -9,6 +9,10 @@ from celery.schedules import crontab
 def deactivate_accounts():
     Inscription.deactivate_accounts()
 
+@celery.task
+def refresh_cache_api_commune(all_=False):
+    return Inscription.refresh_cache_api_commune(all_=all_)
+
 @celery.on_after_configure.connect
 def setup_periodic_inscriptions_tasks(sender, **kwargs):
     sender.add_periodic_task(
@@ -1,47 +1,95 @@
 from ecosante.extensions import celery, sib
-from ecosante.newsletter.models import Newsletter, NewsletterDB, db, Inscription
+from ecosante.newsletter.models import Newsletter, NewsletterDB, EnvironnementCommune, db, Inscription
+from ecosante.utils.rate_limit import is_retryable
+from celery import chain
+from celery.utils.time import get_exponential_backoff_interval
 from flask import current_app
 import os
 import sib_api_v3_sdk
 from sib_api_v3_sdk.rest import ApiException
-from time import sleep
+from time import perf_counter, time
 import json
 
+MAX_RETRIES = int(os.getenv('SIB_TASK_MAX_RETRIES', 5))
+
+def retry(task, e, retry_not_found=False):
+    """Relance la tâche avec un délai exponentiel aléatoire si l’erreur SIB
+    est passagère. Un contact tout juste créé peut ne pas encore être visible
+    par l’API : d’où retry_not_found"""
+    if is_retryable(e) or (retry_not_found and e.status == 404):
+        raise task.retry(
+            exc=e,
+            countdown=get_exponential_backoff_interval(
+                factor=float(os.getenv('SIB_RETRY_BACKOFF', 1)),
+                retries=task.request.retries,
+                maximum=60,
+                full_jitter=True
+            )
+        )
+    current_app.logger.error(f"Error: {e}")
+    raise e
+
+def occupy(confirmation, start):
+    # Temps passé par les workers sur cette inscription, attentes entre les étapes exclues
+    confirmation["occupation"] += perf_counter() - start
+    return confirmation
+
 @celery.task()
 def send_success_email(inscription_id):
+    """Enchaîne la création du contact, la mise à jour de ses attributs et
+    l’envoi du mail de bienvenue, chaque étape étant réessayée séparément"""
     success_template_id = int(os.getenv('SIB_SUCCESS_TEMPLATE_ID', 108))
     if not success_template_id:
         return
-    inscription = Inscription.query.get(inscription_id)
+    confirmation = {"inscription_id": inscription_id, "debut": time(), "occupation": 0}
+    return chain(
+        create_contact.s(confirmation),
+        update_contact_attributes.s(),
+        send_welcome_email.s(success_template_id)
+    ).apply_async().id
 
+@celery.task(bind=True, max_retries=MAX_RETRIES)
+def create_contact(self, confirmation):
+    start = perf_counter()
+    inscription = Inscription.query.get(confirmation["inscription_id"])
     contact_api = sib_api_v3_sdk.ContactsApi(sib)
     try:
         contact_api.create_contact(
             sib_api_v3_sdk.CreateContact(email=inscription.mail,)
         )
     except ApiException as e:
-        if json.loads(e.body)['code'] != 'duplicate_parameter':
-            current_app.logger.error(
-                f"Unable to create_contact: {e}"
-            )
-            raise e
+        if json.loads(e.body or '{}').get('code') != 'duplicate_parameter':
+            retry(self, e)
+    return occupy(confirmation, start)
 
-    newsletter = NewsletterDB(Newsletter(inscription))
-    sleep(0.5)
+@celery.task(bind=True, max_retries=MAX_RETRIES)
+def update_contact_attributes(self, confirmation):
+    start = perf_counter()
+    inscription = Inscription.query.get(confirmation["inscription_id"])
+    environnement = EnvironnementCommune.get(inscription.ville_insee)
+    newsletter = NewsletterDB(Newsletter.from_environnement(inscription, environnement))
+    # La newsletter n’est enregistrée que si SIB a bien reçu ses attributs,
+    # mais son short_id doit être connu avant
+    db.session.add(newsletter)
+    db.session.flush()
+    contact_api = sib_api_v3_sdk.ContactsApi(sib)
     try:
         contact_api.update_contact(
-            newsletter.inscription.mail,
+            inscription.mail,
             sib_api_v3_sdk.UpdateContact(
                 attributes=newsletter.attributes()
             )
         )
     except ApiException as e:
-        current_app.logger.error(
-            f"Error: {e}"
-        )
-        raise e
+        db.session.rollback()
+        retry(self, e, retry_not_found=True)
+    db.session.commit()
+    return occupy(confirmation, start)
 
-    sleep(0.5)
+@celery.task(bind=True, max_retries=MAX_RETRIES)
+def send_welcome_email(self, confirmation, success_template_id):
+    start = perf_counter()
+    inscription = Inscription.query.get(confirmation["inscription_id"])
     email_api = sib_api_v3_sdk.TransactionalEmailsApi(sib)
     try:
         email_api.send_transac_email(
@@ -50,7 +98,7 @@ def send_success_email(inscription_id):
                     name= "Recosanté",
                     email= "hi@recosante.beta.gouv.fr"
                 ),
-                to=[sib_api_v3_sdk.SendSmtpEmailTo(email=newsletter.inscription.mail)],
+                to=[sib_api_v3_sdk.SendSmtpEmailTo(email=inscription.mail)],
                 reply_to=sib_api_v3_sdk.SendSmtpEmailReplyTo(
                     name="Recosanté",
                     email="hi@recosante.beta.gouv.fr"
@@ -59,12 +107,11 @@ def send_success_email(inscription_id):
             )
         )
     except ApiException as e:
-        current_app.logger.error(
-            f"Error: {e}"
-        )
-        raise e
-    db.session.add(newsletter)
-    db.session.commit()
+        retry(self, e)
+    occupy(confirmation, start)
+    confirmation["latence"] = time() - confirmation["debut"]
     current_app.logger.info(
-        f"Mail de confirmation d'inscription envoyé à {newsletter.inscription.mail}"
-    )
\ No newline at end of file
+        f"Mail de confirmation d'inscription envoyé à {inscription.mail} "
+        f"(latence {confirmation['latence']:.1f}s, occupation des workers {confirmation['occupation']:.2f}s)"
+    )
+    return confirmation
@@ -2,28 +2,38 @@ from ecosante.extensions import celery
 from ecosante.utils import send_log_mail
 
 @celery.task()
-def send_unsubscribe(mail, send_mail=True):
-    if not send_mail:
-        return
-    send_log_mail(
-        "Désinscription de la liste de diffusion",
-        f"""
+def send_unsubscribe_digest(mails, unknown_mails=None):
+    """Un seul mail pour toutes les désinscriptions d’un lot"""
+    unknown_mails = unknown_mails or []
+    text_content = """
 Bonjour,
-
-L'utilisateur {mail} s'est désinscrit de la newsletter
-
+"""
+    if mails:
+        text_content += f"""
+{len(mails)} utilisateurs se sont désinscrits de la newsletter :
+""" + "\n".join(mails) + "\n"
+    if unknown_mails:
+        text_content += f"""
+{len(unknown_mails)} utilisateurs ont tenté de se désinscrire mais nous n'avons pas trouvé leur mail en base :
+""" + "\n".join(unknown_mails) + """
+Il pourrait être opportun que l'équipe technique comprenne ce qui s'est passé
+"""
+    text_content += """
 Bonne journée !
-""")
-
-@celery.task()
-def send_unsubscribe_error(mail):
+"""
     send_log_mail(
-        "Erreur lors de la désinscription à la liste de diffusion",
-        f"""
-Bonjour,
+        f"Désinscription de {len(mails)} utilisateurs de la liste de diffusion"
+            + (f", {len(unknown_mails)} erreurs" if unknown_mails else ""),
+        text_content
+    )
 
-L'utilisateur {mail} a tenté de se désinscrire mais nous n'avons pas trouvé son mail en base.
-Il pourrait être opportun que l'équipe technique comprenne ce qui s'est passé
+# Anciennes tâches, gardées le temps que les messages déjà en file sous
+# ces noms soient consommés. À supprimer à la prochaine version
+@celery.task()
+def send_unsubscribe(mail, send_mail=True):
+    if send_mail:
+        send_unsubscribe_digest([mail])
 
-Bonne journée !
-""")
\ No newline at end of file
+@celery.task()
+def send_unsubscribe_error(mail):
+    send_unsubscribe_digest([], [mail])
@@ -0,0 +1,49 @@
+from ecosante.extensions import db
+from ecosante.newsletter.models import Newsletter, NewsletterDB, Inscription, Recommandation
+from sqlalchemy.exc import OperationalError
+from time import perf_counter
+
+
+def newsletters(n):
+    inscription = Inscription.active_query().first()
+    recommandation = Recommandation.published_query().first()
+    if not inscription or not recommandation:
+        raise ValueError("Il faut au moins une inscription active et une recommandation publiée")
+    newsletter = Newsletter(
+        inscription,
+        forecast={"data": []},
+        episodes={"data": []},
+        raep=0,
+        allergenes={"graminees": 0},
+        recommandation_id=recommandation.id
+    )
+    return [NewsletterDB(newsletter) for _ in range(n)]
+
+
+def benchmark_insert(n=10000, batch_size=None):
+    """Insère n newsletters par l’ORM (un INSERT et un appel à
+    generate_random_id par ligne) puis par NewsletterDB.bulk_insert.
+    Les deux insertions sont annulées"""
+    report = {"newsletters": n}
+
+    orm_newsletters = newsletters(n)
+    db.session.commit()
+    start = perf_counter()
+    db.session.add_all(orm_newsletters)
+    try:
+        db.session.flush()
+        report["orm"] = perf_counter() - start
+    except OperationalError as e:
+        # generate_random_id garde un verrou consultatif par ligne jusqu’à la
+        # fin de la transaction : la table des verrous de Postgres finit par saturer
+        report["orm"] = None
+        report["orm_erreur"] = str(e.orig).splitlines()[0]
+    db.session.rollback()
+
+    bulk_newsletters = newsletters(n)
+    db.session.commit()
+    start = perf_counter()
+    NewsletterDB.bulk_insert(bulk_newsletters, batch_size)
+    report["bulk"] = perf_counter() - start
+    db.session.rollback()
+    return report
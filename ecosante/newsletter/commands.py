@@ -0,0 +1,20 @@
+from flask import current_app
+import click
+from .benchmark import benchmark_insert
+
+@current_app.cli.command('benchmark-newsletter-insert')
+@click.option('--n', default=10000)
+@click.option('--batch-size', default=None, type=int)
+def benchmark_newsletter_insert(n, batch_size):
+    report = benchmark_insert(n, batch_size)
+    if report['orm'] is None:
+        click.echo(f"{report['newsletters']} newsletters : échec de l’ORM ({report['orm_erreur']})")
+    else:
+        click.echo(
+            f"{report['newsletters']} newsletters : ORM {report['orm']:.1f}s "
+            f"({report['newsletters']/report['orm']:.0f}/s)"
+        )
+    click.echo(
+        f"{report['newsletters']} newsletters : bulk_insert {report['bulk']:.1f}s "
+        f"({report['newsletters']/report['bulk']:.0f}/s)"
+    )
@@ -1,21 +1,27 @@
-from dataclasses import dataclass
-from typing import List
-from datetime import datetime, date
+from dataclasses import dataclass, field
+from typing import Dict, List
+from datetime import datetime, date, timedelta
 from flask.helpers import url_for
 from indice_pollution.history.models.commune import Commune
 import requests
-from sqlalchemy import text
+from sqlalchemy import text, func
 from sqlalchemy.dialects import postgresql
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.orm import make_transient_to_detached
+from psycopg2.extras import execute_values
 from flask import current_app
 from ecosante.inscription.models import Inscription
 from ecosante.recommandations.models import Recommandation
+from ecosante.recommandations.matcher import RelevanceMatcher
 from ecosante.utils.funcs import (
     convert_boolean_to_oui_non,
     generate_line,
     oxford_comma
 )
 from ecosante.extensions import db
-from indice_pollution import bulk, today, forecast as get_forecast, episodes as get_episodes
+from ecosante.utils.random_id import random_id
+from indice_pollution import bulk, today, forecast as get_forecast, episodes as get_episodes, raep as get_raep
+import os
 
 @dataclass
 class Newsletter:
@@ -27,7 +33,7 @@ class Newsletter:
     raep: int = None
     allergenes: List[str] = None
 
-    def __init__(self, inscription, seed=None, preferred_reco=None, recommandations=None, forecast=None, recommandation_id=None, episodes=None, raep=None, allergenes=None, date_=None):
+    def __init__(self, inscription, seed=None, preferred_reco=None, recommandations=None, forecast=None, recommandation_id=None, episodes=None, raep=None, allergenes=None, date_=None, history=None, matcher=None):
         recommandations = recommandations or Recommandation.shuffled(user_seed=seed, preferred_reco=preferred_reco)
         self.date = date_ or today()
         self.inscription = inscription
@@ -83,7 +89,7 @@ class Newsletter:
 
         self.recommandation =\
             Recommandation.query.get(recommandation_id) or\
-            self.get_recommandation(recommandations)
+            self.get_recommandation(recommandations, history, matcher)
 
     @property
     def polluants_formatted(self):
@@ -151,56 +157,74 @@ class Newsletter:
 
 
     @classmethod
-    def export(cls, preferred_reco=None, user_seed=None, remove_reco=[], only_to=None):
+    def from_environnement(cls, inscription, environnement, **kwargs):
+        """Newsletter construite depuis l’instantané EnvironnementCommune
+        de la commune, sans appel à indice_pollution"""
+        return cls(
+            inscription,
+            forecast=environnement.forecast,
+            episodes=environnement.episodes,
+            raep=(environnement.raep or {}).get("total"),
+            allergenes=(environnement.raep or {}).get("allergenes"),
+            **kwargs
+        )
+
+    @classmethod
+    def export(cls, preferred_reco=None, user_seed=None, remove_reco=[], only_to=None, id_range=None):
         query = Inscription.active_query()
         if only_to:
             query = query.filter(Inscription.mail.in_(only_to))
+        if id_range:
+            query = query.filter(Inscription.id.between(*id_range))
         recommandations = Recommandation.shuffled(user_seed=user_seed, preferred_reco=preferred_reco, remove_reco=remove_reco)
         inscriptions = query.distinct(Inscription.ville_insee)
         insee_region = {i.ville_insee: i.region_name for i in inscriptions}
         try:
-            insee_forecast = bulk(insee_region, fetch_episodes=True, fetch_allergenes=True)
+            environnements = EnvironnementCommune.load(insee_region)
         except requests.exceptions.HTTPError as e:
             current_app.logger.error(e)
             raise e
-        for inscription in query.all():
-            if inscription.ville_insee not in insee_forecast:
+        matcher = RelevanceMatcher(recommandations)
+        mails = query.with_entities(Inscription.mail).subquery("mails")
+        history = NewsletterHistory.load(
+            Inscription.mail.in_(db.session.query(mails.c.mail))
+        )
+        # Trié par id : un envoi découpé en lots produit les mêmes newsletters, dans le même ordre
+        for inscription in query.order_by(Inscription.id).all():
+            environnement = environnements.get(inscription.ville_insee)
+            if not environnement:
                 continue
-            newsletter = cls(
+            newsletter = cls.from_environnement(
                 inscription,
+                environnement,
                 recommandations=recommandations,
-                forecast=insee_forecast[inscription.ville_insee].get("forecast"),
-                episodes=insee_forecast[inscription.ville_insee].get("episode"),
-                raep=insee_forecast[inscription.ville_insee].get("raep", {}).get("total"),
-                allergenes=insee_forecast[inscription.ville_insee].get("raep", {}).get("allergenes")
+                history=history,
+                matcher=matcher
             )
             if inscription.frequence == "pollution" and newsletter.qualif and newsletter.qualif not in ['mauvais', 'tres_mauvais', 'extrement_mauvais']:
                 continue
             yield newsletter
-
-    def get_recommandation(self, recommandations: List[Recommandation]):
-        query_nl = NewsletterDB.query\
-            .join(Inscription)\
-            .filter(Inscription.mail==self.inscription.mail)
-        sorted_recommandation_ids = db.session.query(Recommandation.id)\
-            .join(query_nl.subquery("nl"), isouter=True)\
-            .group_by(Recommandation.id)\
-            .order_by(text("max(nl.date) nulls first"), Recommandation.ordre)\
-            .all()
-        last_nl = query_nl.order_by(text("date DESC")).first()
-        eligible_recommandations = filter(
-            lambda r: r.is_relevant(self.inscription, self.qualif, self.polluants, self.raep, self.date), 
-            sorted(
-                recommandations,
-                key=lambda r: sorted_recommandation_ids.index((r.id,))
-            )
+        current_app.logger.info(
+            f"Recommandations éligibles : {len(matcher.buckets)} groupes, "
+            f"{matcher.bucket_hits} hits, {matcher.bucket_misses} misses "
+            f"({matcher.bucket_hit_rate:.0%})"
         )
-        if not last_nl:
+
+    def get_recommandation(self, recommandations: List[Recommandation], history=None, matcher=None):
+        history = history or NewsletterHistory.load(Inscription.mail==self.inscription.mail)
+        matcher = matcher or RelevanceMatcher(recommandations)
+        # Le tri est stable : trier la liste filtrée revient à filtrer la liste triée
+        eligible_recommandations = iter(history.sort(
+            matcher.eligible(self.inscription, self.qualif, self.polluants, self.raep, self.date),
+            self.inscription.mail
+        ))
+        last_recommandation = history.last_recommandation.get(self.inscription.mail)
+        if not last_recommandation:
             return next(eligible_recommandations)
         else:
             to_send = None
-            last_criteres = last_nl.recommandation.criteres
-            last_type = last_nl.recommandation.type_
+            last_criteres = last_recommandation.criteres
+            last_type = last_recommandation.type_
             for reco in eligible_recommandations:
                 if reco.criteres != last_criteres and reco.type_ != last_type:
                     return reco
@@ -290,11 +314,26 @@ class Newsletter:
 @dataclass
 class NewsletterDB(db.Model, Newsletter):
     __tablename__ = "newsletter"
+    # short_id est déjà indexé par sa contrainte d’unicité
+    __table_args__ = (
+        # Historique d’une inscription : get_recommandation, last_month_newsletters
+        db.Index('ix_newsletter_inscription_id_date', 'inscription_id', 'date'),
+        # Avis donnés : liste_avis, pages.admin
+        db.Index('ix_newsletter_date_avis', 'date', postgresql_where=text('avis IS NOT NULL')),
+        # Recommandations appliquées : recommandations.details
+        db.Index(
+            'ix_newsletter_recommandation_id_date_appliquee',
+            'recommandation_id',
+            'date',
+            postgresql_where=text('appliquee IS NOT NULL')
+        ),
+    )
 
     id: int = db.Column(db.Integer, primary_key=True)
     short_id: str = db.Column(
         db.String(),
-        server_default=text("generate_random_id('public', 'newsletter', 'short_id', 8)")
+        server_default=text("generate_random_id('public', 'newsletter', 'short_id', 8)"),
+        unique=True
     )
     inscription_id: int = db.Column(db.Integer, db.ForeignKey('inscription.id'))
     inscription: Inscription = db.relationship(Inscription)
@@ -327,6 +366,60 @@ class NewsletterDB(db.Model, Newsletter):
         self.raep = int(newsletter.raep)
         self.allergenes = newsletter.allergenes
 
+    @classmethod
+    def bulk_insert(cls, newsletters, batch_size=None, max_attempts=5):
+        """Insère les newsletters par lots, en un INSERT ... ON CONFLICT (short_id)
+        DO NOTHING RETURNING id, short_id par lot (execute_values de psycopg2 :
+        pas de compilation SQLAlchemy par ligne). Les short_id sont tirés en
+        Python : les lignes en collision sont réinsérées avec un nouveau tirage.
+        Les newsletters deviennent détachées avec leur id et leur short_id,
+        sans être relues. Le commit est laissé à l’appelant"""
+        batch_size = batch_size or int(os.getenv('NEWSLETTER_INSERT_BATCH_SIZE', 1000))
+        dialect = db.session.get_bind().dialect
+        columns = [c for c in cls.__table__.columns if c.key not in ('id', 'short_id')]
+        processors = [(c.key, c.type.bind_processor(dialect)) for c in columns]
+        sql = f"""INSERT INTO {cls.__tablename__} (short_id, {', '.join(c.name for c in columns)})
+            VALUES %s
+            ON CONFLICT (short_id) DO NOTHING
+            RETURNING id, short_id"""
+        cursor = db.session.connection().connection.cursor()
+        def row(short_id, nl):
+            values = [short_id]
+            for key, processor in processors:
+                value = getattr(nl, key)
+                values.append(processor(value) if processor and value is not None else value)
+            return values
+        for start in range(0, len(newsletters), batch_size):
+            pending = newsletters[start:start+batch_size]
+            for _ in range(max_attempts):
+                by_short_id = dict()
+                for nl in pending:
+                    short_id = random_id()
+                    while short_id in by_short_id:
+                        short_id = random_id()
+                    by_short_id[short_id] = nl
+                inserted = execute_values(
+                    cursor,
+                    sql,
+                    [row(short_id, nl) for short_id, nl in by_short_id.items()],
+                    page_size=len(by_short_id),
+                    fetch=True
+                )
+                for id_, short_id in inserted:
+                    nl = by_short_id.pop(short_id)
+                    nl.id = id_
+                    nl.short_id = short_id
+                pending = list(by_short_id.values())
+                if not pending:
+                    break
+            if pending:
+                raise RuntimeError(f"Impossible d’attribuer un short_id à {len(pending)} newsletters")
+        for nl in newsletters:
+            if nl in db.session:
+                db.session.expunge(nl)
+            make_transient_to_detached(nl)
+        return [(nl.id, nl.short_id) for nl in newsletters]
+
     def attributes(self):
         return {
             **{
@@ -377,4 +470,182 @@ class NewsletterDB(db.Model, Newsletter):
             .order_by(cls.date.desc())\
             .all()
         for newsletter in newsletters:
-            yield newsletter.csv_line()
\ No newline at end of file
+            yield newsletter.csv_line()
+
+
+@dataclass
+class NewsletterHistory:
+    # mail -> {recommandation_id: date du dernier envoi}
+    last_sent: Dict[str, Dict[int, date]] = field(default_factory=dict)
+    # mail -> recommandation de la dernière newsletter
+    last_recommandation: Dict[str, Recommandation] = field(default_factory=dict)
+
+    @classmethod
+    def load(cls, *criterion):
+        """Charge en deux requêtes l’historique des newsletters de toutes
+        les inscriptions filtrées par `criterion`"""
+        history = cls()
+        last_sent_query = db.session.query(
+                Inscription.mail,
+                NewsletterDB.recommandation_id,
+                func.max(NewsletterDB.date)
+            )\
+            .select_from(NewsletterDB)\
+            .join(Inscription, NewsletterDB.inscription_id == Inscription.id)\
+            .filter(*criterion)\
+            .group_by(Inscription.mail, NewsletterDB.recommandation_id)
+        for mail, recommandation_id, last_date in last_sent_query:
+            history.last_sent.setdefault(mail, dict())[recommandation_id] = last_date
+
+        rank = func.row_number().over(
+            partition_by=Inscription.mail,
+            order_by=(NewsletterDB.date.desc(), NewsletterDB.id.desc())
+        ).label("rank")
+        last_nl = db.session.query(
+                Inscription.mail.label("mail"),
+                NewsletterDB.recommandation_id.label("recommandation_id"),
+                rank
+            )\
+            .select_from(NewsletterDB)\
+            .join(Inscription, NewsletterDB.inscription_id == Inscription.id)\
+            .filter(*criterion)\
+            .subquery("last_nl")
+        last_recommandation_ids = dict(
+            db.session.query(last_nl.c.mail, last_nl.c.recommandation_id)\
+                .filter(last_nl.c.rank == 1)\
+                .all()
+        )
+        recommandations = {
+            r.id: r
+            for r in Recommandation.query.filter(
+                Recommandation.id.in_(set(last_recommandation_ids.values()))
+            )
+        }
+        history.last_recommandation = {
+            mail: recommandations[recommandation_id]
+            for mail, recommandation_id in last_recommandation_ids.items()
+            if recommandation_id in recommandations
+        }
+        return history
+
+    def sort(self, recommandations: List[Recommandation], mail):
+        # Les recommandations jamais envoyées d’abord, puis de la plus
+        # anciennement envoyée à la plus récente, puis par ordre (nulls last).
+        # À égalité, les pollens, qui ne sont pertinentes que deux jours par
+        # semaine, passent avant, puis la recommandation la plus récente
+        last_sent = self.last_sent.get(mail, dict())
+        def key(r):
+            last_date = last_sent.get(r.id)
+            return (
+                last_date is not None,
+                last_date or date.min,
+                r.ordre is None,
+                r.ordre or 0,
+                r.type_ != "pollens",
+                -(r.id or 0)
+            )
+        return sorted(recommandations, key=key)
+
+
+@dataclass
+class EnvironnementCommune(db.Model):
+    """Prévisions, épisodes et RAEP d’une commune pour un jour, tels que
+    renvoyés par indice_pollution. Partagé par l’export de la newsletter,
+    /data et la tâche save_indice"""
+    insee: str = db.Column(db.String, primary_key=True)
+    date: date = db.Column(db.Date, primary_key=True)
+    forecast: dict = db.Column(db.JSON)
+    episodes: dict = db.Column(db.JSON)
+    # {"total": …, "allergenes": {…}}
+    raep: dict = db.Column(db.JSON)
+    updated_at: datetime = db.Column(db.DateTime, nullable=False)
+
+    @staticmethod
+    def max_age():
+        return timedelta(seconds=int(os.getenv('ENVIRONNEMENT_MAX_AGE', 3600)))
+
+    @classmethod
+    def load(cls, insee_region, max_age=None):
+        """insee -> environnement du jour. Les communes absentes ou plus
+        vieilles que max_age sont récupérées en un seul appel à bulk"""
+        date_ = today()
+        max_age = max_age if max_age is not None else cls.max_age()
+        environnements = {
+            e.insee: e
+            for e in cls.query.filter(cls.date == date_, cls.insee.in_(list(insee_region)))
+        }
+        limit = datetime.now() - max_age
+        missing = {
+            insee: region
+            for insee, region in insee_region.items()
+            if insee not in environnements or environnements[insee].updated_at < limit
+        }
+        if missing:
+            fetched = bulk(missing, fetch_episodes=True, fetch_allergenes=True)
+            environnements.update(cls.save(date_, {
+                insee: {
+                    "forecast": v.get("forecast"),
+                    "episodes": v.get("episode"),
+                    "raep": v.get("raep")
+                }
+                for insee, v in fetched.items()
+            }))
+        return environnements
+
+    @classmethod
+    def get(cls, insee, fresh_since=None, persist=True):
+        """Environnement du jour d’une seule commune, récupéré à la demande
+        si la commune n’a pas encore été chargée (aucun inscrit par exemple)
+        ou s’il date d’avant fresh_since. Avec persist=False, l’environnement
+        récupéré n’est pas enregistré"""
+        date_ = today()
+        environnement = cls.query.get((insee, date_))
+        limit = datetime.now() - cls.max_age()
+        if fresh_since:
+            limit = max(limit, fresh_since)
+        if environnement and environnement.updated_at >= limit:
+            return environnement
+        values = {
+            "forecast": get_forecast(insee, date_),
+            "episodes": get_episodes(insee, date_),
+            "raep": get_raep(insee).get("data")
+        }
+        if not persist:
+            return cls(insee=insee, date=date_, updated_at=datetime.now(), **values)
+        return cls.save(date_, {insee: values})[insee]
+
+    @classmethod
+    def save(cls, date_, environnements):
+        if not environnements:
+            return dict()
+        now = datetime.now()
+        statement = insert(cls.__table__).values([
+            {"insee": insee, "date": date_, "updated_at": now, **values}
+            for insee, values in environnements.items()
+        ])
+        db.session.execute(
+            statement.on_conflict_do_update(
+                index_elements=[cls.insee, cls.date],
+                set_={k: statement.excluded[k] for k in ["forecast", "episodes", "raep", "updated_at"]}
+            )
+        )
+        db.session.commit()
+        return {
+            e.insee: e
+            for e in cls.query.populate_existing().filter(
+                cls.date == date_,
+                cls.insee.in_(list(environnements))
+            )
+        }
+
+    @classmethod
+    def refresh(cls, max_age=timedelta(0)):
+        """Récupère l’environnement du jour de toutes les communes ayant
+        des inscrits actifs, et purge les jours trop anciens"""
+        inscriptions = Inscription.active_query().distinct(Inscription.ville_insee)
+        insee_region = {i.ville_insee: i.region_name for i in inscriptions}
+        environnements = cls.load(insee_region, max_age=max_age)
+        retention = int(os.getenv('ENVIRONNEMENT_RETENTION', 7))
+        cls.query.filter(cls.date < today() - timedelta(days=retention)).delete(synchronize_session=False)
+        db.session.commit()
+        return environnements
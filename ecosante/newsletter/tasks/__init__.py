@@ -1,6 +1,5 @@
 from ecosante.extensions import celery
-from ecosante.newsletter.models import Newsletter
-from ecosante.extensions import db
+from ecosante.newsletter.models import EnvironnementCommune
 from flask import current_app
 from celery.schedules import crontab
 
@@ -8,9 +7,8 @@ from .import_in_sb import import_and_send, import_send_and_report #noqa
 
 @celery.task()
 def save_indice():
-    for nl in Newsletter.export():
-        current_app.logger.info(f'Save history for {nl.inscription.ville_insee}')
-    db.session.commit()
+    environnements = EnvironnementCommune.refresh()
+    current_app.logger.info(f'Environnement du jour de {len(environnements)} communes enregistré')
 
 @celery.on_after_configure.connect
 def setup_periodic_tasks(sender, **kwargs):
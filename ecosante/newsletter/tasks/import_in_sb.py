@@ -1,69 +1,70 @@
 from flask import current_app
-from datetime import datetime
+from datetime import datetime, timedelta, timezone
 from uuid import uuid4
+from time import sleep, monotonic
+from concurrent.futures import ThreadPoolExecutor
 import os
 import sib_api_v3_sdk
 from sib_api_v3_sdk.rest import ApiException
-from ecosante.newsletter.models import Newsletter, NewsletterDB, Inscription
+from celery import chord
+from celery.exceptions import Ignore
+from sqlalchemy import func
+from ecosante.newsletter.models import Newsletter, NewsletterDB, Inscription, EnvironnementCommune
+from ecosante.inscription.models import SyncState
 from ecosante.extensions import db, sib, celery
 from ecosante.utils import send_log_mail
+from ecosante.utils.rate_limit import TokenBucket, call_with_retry
+from ecosante.utils.progress import ProgressReporter
 
-def get_all_contacts(limit=100):
+def get_all_contacts(limit=100, modified_since=None):
     contacts_api = sib_api_v3_sdk.ContactsApi(sib)
+    kwargs = {"modified_since": modified_since} if modified_since else {}
     contacts = []
     offset = 0
     while True:
-        result = contacts_api.get_contacts(limit=100, offset=offset)
+        result = contacts_api.get_contacts(limit=limit, offset=offset, **kwargs)
         contacts += result.contacts
         if len(result.contacts) < limit:
             break
         offset += limit
     return contacts
 
-def get_blacklisted_contacts():
-    return [c for c in get_all_contacts() if c['emailBlacklisted']]
+def get_blacklisted_contacts(modified_since=None):
+    return [c for c in get_all_contacts(modified_since=modified_since) if c['emailBlacklisted']]
 
 def deactivate_contacts():
-    for contact in get_blacklisted_contacts():
-        db_contact = Inscription.active_query().filter(Inscription.mail==contact['email']).first()
-        if not db_contact or not db_contact.is_active:
-            continue
-        db_contact.unsubscribe()
-
-def import_and_send(task, seed, preferred_reco, remove_reco, only_to):
-    task.update_state(
-        state='STARTED',
-        meta={
-            "progress": 0,
-            "details": "Prise en compte de la désincription des membres"
-        }
+    """Désinscrit les contacts blacklistés dans SIB. Seuls les contacts modifiés
+    depuis la dernière synchronisation réussie sont lus, avec une marge de
+    SIB_SYNC_OVERLAP minutes"""
+    synced_at = SyncState.get('sib_blacklist').synced_at
+    start = datetime.now(timezone.utc)
+    modified_since = None
+    if synced_at:
+        modified_since = (synced_at - timedelta(minutes=int(os.getenv('SIB_SYNC_OVERLAP', 5))))\
+            .astimezone(timezone.utc)\
+            .strftime('%Y-%m-%dT%H:%M:%S.000Z')
+    contacts = get_blacklisted_contacts(modified_since)
+    desinscrites, _ = Inscription.bulk_unsubscribe(c['email'] for c in contacts)
+    # Le point de reprise n’avance qu’une fois les désinscriptions enregistrées
+    SyncState.get('sib_blacklist').synced_at = start
+    db.session.commit()
+    current_app.logger.info(
+        f"{len(contacts)} contacts blacklistés depuis {modified_since or 'toujours'}, "
+        f"{len(desinscrites)} inscriptions désactivées"
     )
+    return desinscrites
+
+def prepare(reporter):
+    reporter.report("Prise en compte de la désincription des membres", force=True)
     deactivate_contacts()
-    task.update_state(
-        state='STARTED',
-        meta={
-            "progress": 0,
-            "details": "Suppression des anciennes listes"
-        }
-    )
+    reporter.report("Suppression des anciennes listes", force=True)
     list_ids_to_delete = get_lists_ids_to_delete()
     contacts_api = sib_api_v3_sdk.ContactsApi(sib)
     for i, list_id in enumerate(list_ids_to_delete, 1):
         contacts_api.delete_list(list_id)
-        task.update_state(
-            state='STARTED',
-            meta={
-                "progress": 0,
-                "details": f"Suppression des anciennes listes ({i}/{len(list_ids_to_delete)})"
-            }
-        )
-    task.update_state(
-        state='STARTED',
-        meta={
-            "progress": 0,
-            "details": "Constitution de la liste"
-        }
-    )
+        reporter.report(f"Suppression des anciennes listes ({i}/{len(list_ids_to_delete)})")
+
+def build_newsletters(seed, preferred_reco, remove_reco, only_to, id_range=None):
     newsletters = list(
         map(
             NewsletterDB,
@@ -71,43 +72,107 @@ def import_and_send(task, seed, preferred_reco, remove_reco, only_to):
                 preferred_reco=preferred_reco,
                 user_seed=seed,
                 remove_reco=remove_reco,
-                only_to=only_to
+                only_to=only_to,
+                id_range=id_range
             )
         )
     )
-    db.session.add_all(newsletters)
+    NewsletterDB.bulk_insert(newsletters)
     db.session.commit()
-    task.update_state(
-        state='STARTED',
-        meta={
-            "progress" :0,
-            "details": "Construction des listes SIB d'envoi"
-        }
-    )
-    result = import_(task, newsletters, 2)
+    return newsletters
+
+def send(task, reporter, newsletters):
+    reporter.report("Construction des listes SIB d'envoi", force=True)
+    result = import_(task, newsletters, 2, task_id=reporter.task_id)
     if current_app.config['ENV'] == 'production':
         send_email_api = sib_api_v3_sdk.EmailCampaignsApi(sib)
         send_email_api.send_email_campaign_now(result["email_campaign_id"])
-        task.update_state(
-            state='STARTED',
-            meta={
-                "progress": 99,
-                "details": "Envoi de la liste email",
-                "email_campaign_id": result['email_campaign_id'],
-            }
+        reporter.report(
+            "Envoi de la liste email",
+            force=True,
+            progress=99,
+            email_campaign_id=result['email_campaign_id']
         )
     result['progress'] = 100
     db.session.commit()
     return result
 
-def import_(task, newsletters, overhead=0):
+def import_and_send(task, seed, preferred_reco, remove_reco, only_to):
+    reporter = ProgressReporter(task)
+    prepare(reporter)
+    reporter.report("Constitution de la liste", force=True)
+    newsletters = build_newsletters(seed, preferred_reco, remove_reco, only_to)
+    return send(task, reporter, newsletters)
+
+def shard_ranges(shards, only_to=None):
+    """Découpe les inscriptions actives en `shards` intervalles d’id
+    (bornes incluses) de tailles égales"""
+    query = Inscription.active_query()
+    if only_to:
+        query = query.filter(Inscription.mail.in_(only_to))
+    ids = query.with_entities(
+            Inscription.id.label('id'),
+            func.ntile(shards).over(order_by=Inscription.id).label('shard')
+        )\
+        .subquery()
+    return [
+        (lo, hi)
+        for lo, hi in db.session.query(func.min(ids.c.id), func.max(ids.c.id))\
+            .group_by(ids.c.shard)\
+            .order_by(ids.c.shard)
+    ]
+
+@celery.task()
+def build_newsletters_shard(seed, preferred_reco, remove_reco, only_to, id_range):
+    newsletters = build_newsletters(seed, preferred_reco, remove_reco, only_to, id_range)
+    current_app.logger.info(f"Lot {id_range} : {len(newsletters)} newsletters")
+    return [nl.id for nl in newsletters]
+
+@celery.task(bind=True)
+def send_and_report(self, shards_ids, coordinator_id=None):
+    """Callback du chord : les newsletters des lots, remises dans l’ordre
+    des lots, passent par le même import_ qu’un envoi en un seul processus.
+    L’avancement et le résultat sont aussi publiés sous l’id de la tâche
+    coordinatrice, celle que suit la page de progression"""
+    try:
+        ids = [id_ for shard_ids in shards_ids for id_ in shard_ids]
+        by_id = {nl.id: nl for nl in NewsletterDB.query.filter(NewsletterDB.id.in_(ids))}
+        result = send(self, ProgressReporter(self, task_id=coordinator_id), [by_id[id_] for id_ in ids])
+        report(result['errors'])
+    except Exception as e:
+        if coordinator_id:
+            self.backend.mark_as_failure(coordinator_id, e)
+        raise
+    # Les objets NewsletterDB ne sont pas sérialisables en JSON
+    result['errors'] = [{k: v for k, v in e.items() if k != 'nl'} for e in result['errors']]
+    if coordinator_id:
+        self.update_state(task_id=coordinator_id, state='SUCCESS', meta=result)
+    return result
+
+def import_send_sharded(task, seed, preferred_reco, remove_reco, only_to, shards):
+    """Les lots sont construits en parallèle par les workers, puis send_and_report
+    crée la liste et la campagne SIB et envoie le rapport"""
+    reporter = ProgressReporter(task)
+    prepare(reporter)
+    reporter.report("Récupération de l’environnement des communes", force=True)
+    # Les lots lisent ensuite l’instantané au lieu d’appeler chacun bulk
+    EnvironnementCommune.refresh(max_age=None)
+    id_ranges = shard_ranges(shards, only_to)
+    result = chord(
+        build_newsletters_shard.s(seed, preferred_reco, remove_reco, only_to, id_range)
+        for id_range in id_ranges
+    )(send_and_report.s(coordinator_id=task.request.id))
+    reporter.report(f"Constitution de la liste en {len(id_ranges)} lots", force=True, chord_id=result.id)
+    # La tâche reste STARTED : son état final est écrit par send_and_report
+    raise Ignore()
+
+def import_(task, newsletters, overhead=0, task_id=None):
     email_campaign_id = None,
     errors = []
     
     now = datetime.now()
-    total_nb_requests = 4 + len(newsletters) + overhead
-    nb_requests = 0
-    lists_api = sib_api_v3_sdk.ListsApi(sib)
+    reporter = ProgressReporter(task, 4 + len(newsletters) + overhead, task_id=task_id)
+    lists_api = sib_api_v3_sdk.ContactsApi(sib)
     r = lists_api.create_list(
         sib_api_v3_sdk.CreateList(
             name=f'{now} - mail',
@@ -115,50 +180,33 @@ def import_(task, newsletters, overhead=0):
         )
     )
     mail_list_id = r.id
-    nb_requests += 1
-    task.update_state(
-        state='STARTED',
-        meta={
-            "progress": (nb_requests/total_nb_requests)*100,
-            "details": f"Création de la liste"
-        }
-    )
+    reporter.advance(1, "Création de la liste", force=True)
 
-    contact_api = sib_api_v3_sdk.ContactsApi(sib)
+    to_import = []
     for i, nl in enumerate(newsletters):
         if nl.label is None:
             errors.append({
                 "type": "no_air_quality",
                 "nl": nl,
-                "region": nl.inscription.cache_api_commune['region']['nom'],
+                "region": nl.inscription.region_name,
                 "ville": nl.inscription.ville_nom,
                 "insee": nl.inscription.ville_insee
             })
             current_app.logger.error(f"No qai for {nl.inscription.mail}")
+            reporter.advance(1, f"Mise à jour des contacts {i}/{len(newsletters)}")
         else:
-            try:
-                if current_app.config['ENV'] == 'production':
-                    contact_api.update_contact(
-                        nl.inscription.mail,
-                        sib_api_v3_sdk.UpdateContact(
-                            attributes=nl.attributes(),
-                            list_ids=[mail_list_id]
-                        )
-                    )
-            except ApiException as e:
-                current_app.logger.error(f"Error updating {nl.inscription.mail}")
-                current_app.logger.error(e)
-            current_app.logger.info(f"Mise à jour de {nl.inscription.mail}")
-        nb_requests += 1
-        task.update_state(
-            state='STARTED',
-            meta={
-                "progress": (nb_requests/total_nb_requests)*100,
-                "details": f"Mise à jour des contacts {i}/{len(newsletters)}"
-            }
-        )
-        db.session.add(nl)
-    db.session.commit()
+            to_import.append(nl)
+
+    chunk_size = int(os.getenv('SIB_IMPORT_CHUNK_SIZE', 1000))
+    for start in range(0, len(to_import), chunk_size):
+        chunk = to_import[start:start+chunk_size]
+        if current_app.config['ENV'] == 'production':
+            import_contacts(
+                [(nl.inscription.mail, nl.attributes()) for nl in chunk],
+                mail_list_id
+            )
+        current_app.logger.info(f"Mise à jour de {len(chunk)} contacts")
+        reporter.advance(len(chunk), f"Mise à jour des contacts {start+len(chunk)}/{len(to_import)}")
 
     if current_app.config['ENV'] == 'production':
         template_id = os.getenv('SIB_EMAIL_TEMPLATE_ID', 425)
@@ -184,23 +232,86 @@ def import_(task, newsletters, overhead=0):
         email_campaign_id = r.id
     else:
         email_campaign_id = 0
-    nb_requests += 1
-    task.update_state(
-        state='STARTED',
-        meta={
-            "progress": (nb_requests/total_nb_requests)*100,
-            "details": f"Création de la campagne mail",
-            "email_campaign_id": email_campaign_id
-        }
+    reporter.advance(
+        1,
+        "Création de la campagne mail",
+        force=True,
+        email_campaign_id=email_campaign_id
     )
     return {
         "state": "STARTED",
-        "progress": (nb_requests/total_nb_requests)*100,
+        "progress": reporter.progress,
         "details": "Terminé",
         "email_campaign_id": email_campaign_id,
         "errors": errors
     }
 
+def import_contacts(contacts, list_id):
+    """Importe en un seul job SIB une liste de couples (mail, attributs).
+    Si le job échoue ou n’aboutit pas, on se rabat sur un update_contact par contact"""
+    contacts_api = sib_api_v3_sdk.ContactsApi(sib)
+    try:
+        r = contacts_api.import_contacts(
+            sib_api_v3_sdk.RequestContactImport(
+                json_body=[
+                    {"email": mail, "attributes": attributes}
+                    for mail, attributes in contacts
+                ],
+                list_ids=[list_id],
+                update_existing_contacts=True,
+                # Un attribut vide aujourd’hui (POLLUANT, RAEP…) doit effacer celui de la veille
+                empty_contacts_attributes=True
+            )
+        )
+        if wait_for_process(r.process_id):
+            return
+        current_app.logger.error(f"Import process {r.process_id} did not complete, updating contacts one by one")
+    except ApiException as e:
+        current_app.logger.error(f"Error importing {len(contacts)} contacts, updating contacts one by one")
+        current_app.logger.error(e)
+    update_contacts(contacts, list_id)
+
+def update_contacts(contacts, list_id):
+    """Met à jour les contacts un par un, en parallèle mais sous les quotas SIB.
+    Renvoie les couples (mail, exception) des échecs, dans l’ordre des contacts"""
+    contacts_api = sib_api_v3_sdk.ContactsApi(sib)
+    bucket = TokenBucket(float(os.getenv('SIB_RATE_LIMIT', 10)))
+
+    def update(contact):
+        mail, attributes = contact
+        try:
+            call_with_retry(
+                contacts_api.update_contact,
+                mail,
+                sib_api_v3_sdk.UpdateContact(
+                    attributes=attributes,
+                    list_ids=[list_id]
+                ),
+                bucket=bucket
+            )
+        except ApiException as e:
+            return (mail, e)
+
+    with ThreadPoolExecutor(max_workers=int(os.getenv('SIB_CONCURRENCY', 4))) as executor:
+        failures = [f for f in executor.map(update, contacts) if f]
+    for mail, e in failures:
+        current_app.logger.error(f"Error updating {mail}")
+        current_app.logger.error(e)
+    return failures
+
+def wait_for_process(process_id):
+    poll_interval = float(os.getenv('SIB_IMPORT_POLL_INTERVAL', 2))
+    timeout = float(os.getenv('SIB_IMPORT_TIMEOUT', 600))
+    process_api = sib_api_v3_sdk.ProcessApi(sib)
+    deadline = monotonic() + timeout
+    while True:
+        process = process_api.get_process(process_id)
+        if process.status == 'completed':
+            return True
+        if monotonic() > deadline:
+            return False
+        sleep(poll_interval)
+
 def format_errors(errors):
     if not errors:
         return ''
@@ -231,8 +342,22 @@ def import_send_and_report(self, only_to=None):
             "details": f"Lancement de la tache: '{new_task_id}'",
         }
     )
+    shards = int(os.getenv('NEWSLETTER_SHARDS', 1))
+    if shards > 1:
+        return import_send_sharded(self, str(uuid4()), None, [], only_to, shards)
     result = import_and_send(self, str(uuid4()), None, [], only_to)
-    errors = format_errors(result['errors'])
+    report(result['errors'])
+    self.update_state(
+        state='SUCESS',
+        meta={
+            "progress": 100,
+            "details": f"Fin",
+        }
+    )
+    return result
+
+def report(errors):
+    errors = format_errors(errors)
     body = """
 Bonjour,
 Il n’y a pas eu d’erreur lors de l’envoi de la newsletter
@@ -245,14 +370,6 @@ Il y a eu des erreurs lors de l’envoi de la newsletter :
 Bonne journée
 """
     send_log_mail("Rapport d’envoi de la newsletter", body, name="Rapport recosante", email="rapport-envoi@recosante.beta.gouv.fr")
-    self.update_state(
-        state='SUCESS',
-        meta={
-            "progress": 100,
-            "details": f"Fin",
-        }
-    )
-    return result
 
 def get_lists_ids_to_delete():
     api_instance = sib_api_v3_sdk.ContactsApi(sib)
@@ -0,0 +1,61 @@
+from ecosante.inscription import communes
+from indice_pollution import availability
+from indice_pollution.regions.solvers import get_region
+from ecosante.utils.cache import TTLCache
+from threading import Lock
+from time import monotonic
+import os
+import re
+
+# Codes INSEE des communes, Corse comprise (2A, 2B)
+INSEE_RE = re.compile(r'^(\d{2}|2A|2B)\d{3}$')
+
+
+class AvailabilityIndex:
+    """INSEE -> disponibilité des prévisions. Pour indice_pollution la
+    disponibilité ne dépend que de la région de la commune : on la calcule
+    une fois par région et on l’étend à toutes les communes de l’index local"""
+
+    def __init__(self, ttl=None):
+        self.ttl = ttl if ttl is not None else int(os.getenv('CITY_AVAILABILITY_TTL', 24*3600))
+        self.availabilities = None
+        self.built_at = None
+        self.lock = Lock()
+        # Communes absentes de l’index local, demandées à indice_pollution
+        self.misses = TTLCache(self.ttl, maxsize=int(os.getenv('CITY_AVAILABILITY_MISSES_MAXSIZE', 10000)))
+
+    @staticmethod
+    def region_availability(region_name):
+        try:
+            return bool(get_region(region_name=region_name).Service.is_active)
+        except (KeyError, AttributeError):
+            return False
+
+    def build(self):
+        regions = dict()
+        availabilities = dict()
+        for insee, commune in communes.get_index().communes.items():
+            region_name = (commune.get('region') or {}).get('nom')
+            if not region_name in regions:
+                regions[region_name] = self.region_availability(region_name) if region_name else False
+            availabilities[insee] = regions[region_name]
+        self.availabilities = availabilities
+        self.built_at = monotonic()
+        return self
+
+    def get(self, insee):
+        if self.availabilities is None or monotonic() - self.built_at > self.ttl:
+            with self.lock:
+                if self.availabilities is None or monotonic() - self.built_at > self.ttl:
+                    self.build()
+        if insee in self.availabilities:
+            return self.availabilities[insee]
+        if not isinstance(insee, str) or not INSEE_RE.match(insee):
+            return False
+        return self.misses.get_or_set(insee, lambda: bool(availability(insee)))
+
+    def get_many(self, insees):
+        return {insee: self.get(insee) for insee in insees}
+
+
+index = AvailabilityIndex()
@@ -2,15 +2,22 @@ from ecosante.tasks.inscriptions_patients import inscription_patients_task
 from flask import (
     redirect,
     render_template,
-    request
+    request,
+    json,
+    Response
 )
 from dataclasses import asdict
+from hashlib import sha1
+import os
 from ecosante.utils import Blueprint
 from ecosante.utils.decorators import admin_capability_url, webhook_capability_url
+from ecosante.utils.cache import TTLCache, last_time, seconds_until
 from datetime import date, timedelta
-from ecosante.newsletter.models import NewsletterDB, Recommandation
+from ecosante.newsletter.models import NewsletterDB, Recommandation, EnvironnementCommune
+from ecosante.inscription.models import Inscription
+from ecosante.extensions import db
 from sentry_sdk import capture_event
-from indice_pollution import forecast, episodes, raep, availability
+from . import availability
 
 bp = Blueprint("pages", __name__, url_prefix='/')
 
@@ -82,17 +89,34 @@ def inscription_patients():
 def city_availability():
     insee = request.args.get('insee')
     if not insee:
-        {"availability": False}, 404
-    return {"availability": availability(insee)}
-
-
-@bp.route('/data')
-def data():
-    d = date.today()
-    insee = request.args.get('insee')
-    f = forecast(insee, d)
-    ep = episodes(insee, d)
-    r = raep(insee)
+        return {"availability": False}, 404
+    return {"availability": availability.index.get(insee)}
+
+
+@bp.route('/city-availability/bulk', methods=['GET', 'POST'])
+def cities_availability():
+    insees = request.args.getlist('insee') or (request.get_json(silent=True) or {}).get('insee') or []
+    max_insees = int(os.getenv('CITY_AVAILABILITY_BULK_MAX', 100))
+    if not isinstance(insees, list) or len(insees) > max_insees or not all(isinstance(i, str) for i in insees):
+        return {"error": f"Au plus {max_insees} codes INSEE"}, 400
+    return {"availability": availability.index.get_many(insees)}
+
+
+def publication_hours():
+    return [int(h) for h in os.getenv('FORECAST_PUBLICATION_HOURS', '13,15').split(',')]
+
+def compute_data(insee, d):
+    # Un environnement d’avant la dernière publication est récupéré à nouveau,
+    # mais n’est enregistré que pour les communes qui ont des inscrits
+    environnement = EnvironnementCommune.get(
+        insee,
+        fresh_since=last_time(publication_hours()),
+        persist=db.session.query(
+            Inscription.active_query().filter(Inscription.ville_insee == insee).exists()
+        ).scalar()
+    )
+    f = environnement.forecast
+    ep = environnement.episodes
     polluants = [
         {
             '1': 'dioxyde_soufre',
@@ -114,6 +138,26 @@ def data():
         "forecast": f['data'][0] if f['data'] else [],
         "episode": ep['data'][0] if ep['data'] else [],
         "recommandation": {k: v for k, v in (asdict(reco[0]) if reco else {}).items() if k in ["precisions", "recommandation"]},
-        "raep": r.get('data'),
+        "raep": environnement.raep,
         "metadata": f['metadata']
     }
+
+
+# Une réponse par (insee, jour), gardée jusqu’à la prochaine publication
+# des prévisions (FORECAST_PUBLICATION_HOURS, heures séparées par des virgules)
+data_cache = TTLCache(3600, maxsize=int(os.getenv('DATA_CACHE_MAXSIZE', 50000)))
+
+@bp.route('/data')
+def data():
+    d = date.today()
+    insee = request.args.get('insee')
+    ttl = seconds_until(publication_hours())
+    def compute():
+        body = json.dumps(compute_data(insee, d))
+        return body, sha1(body.encode()).hexdigest()
+    body, etag = data_cache.get_or_set((insee, d), compute, ttl=ttl)
+    response = Response(body, mimetype="application/json")
+    response.set_etag(etag)
+    response.cache_control.public = True
+    response.cache_control.max_age = ttl
+    return response.make_conditional(request)
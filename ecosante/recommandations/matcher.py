@@ -0,0 +1,190 @@
+from dataclasses import dataclass
+from datetime import date
+from typing import Dict, Iterable, List, Tuple
+from ecosante.inscription.models import Inscription
+from .models import Recommandation
+
+CRITERES = ["menage", "bricolage", "jardinage", "velo", "transport_en_commun", "voiture", "sport"]
+POLLUANTS = ['ozone', 'dioxyde_azote', 'dioxyde_soufre', 'particules_fines']
+SAISONS = ['hiver', 'printemps', 'ete', 'automne']
+
+# Bits de population : la recommandation exige des bits, l’inscription les fournit
+POPULATION_SENSIBLE_OU_ENFANTS = 1 << 0
+POPULATION_NON_SENSIBLE = 1 << 1
+POPULATION_ENFANTS = 1 << 2
+
+QUALIF_BON = 1 << 0
+QUALIF_MAUVAIS = 1 << 1
+
+
+def to_mask(names: List[str], values: Iterable[str]) -> int:
+    values = set(values or [])
+    return sum(1 << i for i, name in enumerate(names) if name in values)
+
+
+@dataclass(frozen=True)
+class RecommandationMask:
+    criteres: int
+    chauffage: int
+    population: int
+    polluants: int
+    qa: int
+    qa_filtre: bool
+    pollens: bool
+    saison: int
+    montrer_dans_le_widget: bool
+
+
+@dataclass(frozen=True)
+class InscriptionMask:
+    criteres: int
+    chauffage: int
+    population: int
+    allergie_pollens: bool
+
+
+@dataclass(frozen=True)
+class EnvironnementMask:
+    qualif: bool
+    qa: int
+    polluants: int
+    raep: int
+    jour_pollens: bool
+    saison: int
+
+    @classmethod
+    def compile(cls, qualif: str, polluants: List[str], raep: int, date_: date):
+        categorie = Recommandation.qualif_categorie(qualif)
+        return cls(
+            qualif=bool(qualif),
+            qa=QUALIF_BON if categorie == "bon" else QUALIF_MAUVAIS if categorie == "mauvais" else 0,
+            polluants=to_mask(POLLUANTS, polluants),
+            raep=raep,
+            jour_pollens=date_.weekday() in [2, 5], #On envoie le mercredi et le samedi
+            saison=1 << (date_.month%12//3)
+        )
+
+
+class RelevanceMatcher:
+    """Version compilée en masques de bits de `Recommandation.is_relevant`.
+    Chaque recommandation est compilée une seule fois, l’inscription et
+    l’environnement une fois par newsletter.
+    Les listes de recommandations éligibles sont mémorisées par couple
+    (profil, environnement) : tous les inscrits d’une même commune qui ont
+    le même profil partagent la même liste."""
+
+    def __init__(self, recommandations: List[Recommandation]=None):
+        self.chauffages: Dict[str, int] = dict()
+        self.masks: Dict[int, RecommandationMask] = dict()
+        self.buckets: Dict[Tuple[InscriptionMask, EnvironnementMask], List[Recommandation]] = dict()
+        self.bucket_hits = 0
+        self.bucket_misses = 0
+        # On garde une référence sur les recommandations pour que leur id() reste valide
+        self.recommandations: List[Recommandation] = []
+        for recommandation in recommandations or []:
+            self.compile_recommandation(recommandation)
+
+    def chauffage_mask(self, chauffages: Iterable[str]) -> int:
+        mask = 0
+        for chauffage in chauffages or []:
+            bit = self.chauffages.setdefault(chauffage, 1 << len(self.chauffages))
+            mask |= bit
+        return mask
+
+    def compile_recommandation(self, recommandation: Recommandation) -> RecommandationMask:
+        key = id(recommandation)
+        if key in self.masks:
+            return self.masks[key]
+        population = 0
+        if recommandation.personnes_sensibles:
+            population |= POPULATION_SENSIBLE_OU_ENFANTS
+        if recommandation.autres:
+            population |= POPULATION_NON_SENSIBLE
+        if recommandation.enfants:
+            population |= POPULATION_ENFANTS
+        mask = RecommandationMask(
+            criteres=to_mask(CRITERES, recommandation.criteres),
+            chauffage=self.chauffage_mask(recommandation.chauffage),
+            population=population,
+            polluants=to_mask(POLLUANTS, recommandation.polluants),
+            qa=(QUALIF_BON if recommandation.qa_bonne else 0) | (QUALIF_MAUVAIS if recommandation.qa_mauvaise else 0),
+            qa_filtre=recommandation.qa_bonne is not None or recommandation.qa_mauvaise is not None,
+            pollens=recommandation.type_ == "pollens",
+            saison=to_mask(SAISONS, recommandation.saison),
+            montrer_dans_le_widget=bool(recommandation.montrer_dans_le_widget)
+        )
+        self.masks[key] = mask
+        self.recommandations.append(recommandation)
+        return mask
+
+    def compile_inscription(self, inscription: Inscription) -> InscriptionMask:
+        if not inscription:
+            return None
+        population = 0
+        if inscription.personne_sensible or inscription.has_enfants:
+            population |= POPULATION_SENSIBLE_OU_ENFANTS
+        if not inscription.personne_sensible:
+            population |= POPULATION_NON_SENSIBLE
+        if inscription.has_enfants:
+            population |= POPULATION_ENFANTS
+        return InscriptionMask(
+            criteres=to_mask(CRITERES, inscription.criteres),
+            chauffage=self.chauffage_mask(inscription.chauffage),
+            population=population,
+            allergie_pollens=bool(inscription.allergie_pollens)
+        )
+
+    @staticmethod
+    def is_relevant_mask(r: RecommandationMask, i: InscriptionMask, e: EnvironnementMask) -> bool:
+        if not i:
+            return r.montrer_dans_le_widget
+        #Inscription
+        if r.criteres and not r.criteres & i.criteres:
+            return False
+        if r.chauffage and not r.chauffage & i.chauffage:
+            return False
+        if r.population & ~i.population:
+            return False
+        # Environnement
+        if e.polluants:
+            return bool(r.polluants & e.polluants)
+        if r.polluants:
+            return False
+        if e.qualif and r.qa_filtre and not r.qa & e.qa:
+            return False
+        # Pollens
+        if r.pollens:
+            if e.raep == 0:
+                return False
+            if e.raep > 0:
+                return i.allergie_pollens and e.jour_pollens
+        if r.saison & ~e.saison:
+            return False
+        return True
+
+    def is_relevant(self, recommandation: Recommandation, inscription: Inscription, qualif: str, polluants: List[str], raep: int, date_: date) -> bool:
+        return self.is_relevant_mask(
+            self.compile_recommandation(recommandation),
+            self.compile_inscription(inscription),
+            EnvironnementMask.compile(qualif, polluants, raep, date_)
+        )
+
+    def eligible(self, inscription: Inscription, qualif: str, polluants: List[str], raep: int, date_: date) -> List[Recommandation]:
+        """Recommandations pertinentes, dans l’ordre où elles ont été données au matcher"""
+        i = self.compile_inscription(inscription)
+        e = EnvironnementMask.compile(qualif, polluants, raep, date_)
+        key = (i, e)
+        if key in self.buckets:
+            self.bucket_hits += 1
+        else:
+            self.bucket_misses += 1
+            self.buckets[key] = [
+                r for r in self.recommandations
+                if self.is_relevant_mask(self.masks[id(r)], i, e)
+            ]
+        return self.buckets[key]
+
+    @property
+    def bucket_hit_rate(self) -> float:
+        total = self.bucket_hits + self.bucket_misses
+        return self.bucket_hits / total if total else 0
@@ -16,14 +16,17 @@ document.addEventListener('DOMContentLoaded', e => {
             data: '/inscription/geojson',
             cluster: true,
             clusterMaxZoom: 14,
-            clusterRadius: 50
+            clusterRadius: 50,
+            // Chaque point regroupe déjà les inscrits d’une commune
+            clusterProperties: {
+                count: ['+', ['get', 'count']]
+            }
         })
          
         map.addLayer({
             id: 'unclustered-point',
             type: 'circle',
             source: 'inscriptions',
-            filter: ['has', 'point_count'],
             paint: {
             'circle-color': '#11b4da',
             'circle-radius': 15,
@@ -35,9 +38,8 @@ document.addEventListener('DOMContentLoaded', e => {
             id: 'cluster-count',
             type: 'symbol',
             source: 'inscriptions',
-            filter: ['has', 'point_count'],
             layout: {
-            'text-field': '{point_count_abbreviated}',
+            'text-field': ['to-string', ['get', 'count']],
             'text-font': ['DIN Offc Pro Medium', 'Arial Unicode MS Bold'],
             'text-size': 12
             }
@@ -1,22 +1,20 @@
 from datetime import date, datetime, timedelta
-from flask import current_app, render_template
+from flask import render_template, make_response, jsonify
 from flask.globals import request
-from ecosante.extensions import db, sib
-from ecosante.inscription.models import Inscription
-from ecosante.avis.models import Avis
+from ecosante.extensions import db
 from ecosante.avis.forms import Form
 from ecosante.utils.blueprint import Blueprint
-from sqlalchemy import func, or_
-from calendar import month_name, different_locale
+from .models import StatsJour, StatsDecouverte
+from sqlalchemy import func
+from itertools import accumulate, groupby
 import json
-from dateutil.parser import parse, ParserError
-import sib_api_v3_sdk
-from sib_api_v3_sdk.rest import ApiException
-from itertools import accumulate
+import os
 
-def get_month_name(month_no, locale):
-    with different_locale(locale):
-        return month_name[month_no]
+MONTH_NAMES = [None, "janvier", "février", "mars", "avril", "mai", "juin", "juillet",
+    "août", "septembre", "octobre", "novembre", "décembre"]
+
+def get_month_name(month_no):
+    return MONTH_NAMES[month_no]
 
 bp = Blueprint("stats", __name__)
 
@@ -27,82 +25,52 @@ def first_day_last_day_of_week(d):
     last_day = datetime.fromisocalendar(year, week, 7)
     return f'{first_day.strftime("%d/%m/%Y")} au {last_day.strftime("%d/%m/%Y")}'
 
+def sum_by(rows, key, value):
+    return [(k, sum(value(r) for r in g)) for k, g in groupby(rows, key)]
+
 @bp.route('/')
 def stats():
-    func_count_id = func.count(Inscription.id)
-    g = func.date_trunc('month', Inscription.date_inscription)
-    active_users = {
-        f"{get_month_name(v[0].month, 'fr_FR.utf8')} {v[0].year}": v[1]
-        for v in
-        db.session.query(g, func_count_id).filter(or_(Inscription.deactivation_date == None, Inscription.deactivation_date > date.today())).group_by(g).order_by(g).all()
-    }
-    all_users = dict(accumulate([
-        (f"{get_month_name(v[0].month, 'fr_FR.utf8')} {v[0].year}", v[1])
-        for v in
-        db.session.query(g, func_count_id).group_by(g).order_by(g).all()
-    ], lambda acc, i: (i[0], acc[1] + i[1])))
+    jours = StatsJour.query.order_by(StatsJour.date).all()
+    month = lambda s: f"{get_month_name(s.date.month)} {s.date.year}"
+    active_users = dict(sum_by(jours, month, lambda s: s.inscriptions_actives))
+    all_users = dict(accumulate(
+        sum_by(jours, month, lambda s: s.inscriptions),
+        lambda acc, i: (i[0], acc[1] + i[1])
+    ))
     last_month = (datetime.now() - timedelta(weeks=5)).date()
-    g_sub = func.date_trunc('week', Inscription.date_inscription)
-    inscriptions = {
-        v[0]: v[1]
-        for v in
-        db.session.query(g_sub, func_count_id).filter(Inscription.date_inscription >= last_month).group_by(g_sub).order_by(g_sub).all()
-    }
-    g_unsub = func.date_trunc('week', Inscription.deactivation_date)
-    desinscriptions = {
-        v[0]: v[1]
-        for v in
-        db.session.query(g_unsub, func_count_id).filter(Inscription.deactivation_date >= last_month).group_by(g_unsub).order_by(g_unsub).all()
-    }
+    week = lambda s: s.date - timedelta(days=s.date.weekday())
+    derniers_jours = [s for s in jours if s.date >= last_month]
+    inscriptions = dict(sum_by(derniers_jours, week, lambda s: s.inscriptions))
+    desinscriptions = dict(sum_by(derniers_jours, week, lambda s: s.desinscriptions))
     inscriptions_desinscriptions = [
-        [first_day_last_day_of_week(v[0]), [v[1], desinscriptions[v[0]]]]
-        for v in inscriptions.items()
-        if v[0] in desinscriptions
+        [first_day_last_day_of_week(w), [n, desinscriptions[w]]]
+        for w, n in inscriptions.items()
+        if n and desinscriptions.get(w)
     ]
     decouverte_labels = {v[0]: v[1] for v in Form.decouverte.kwargs["choices"]}
-    decouverte_unnest_query = db.session.query(func.unnest(Avis.decouverte).label('d')).subquery()
-    decouverte_col = decouverte_unnest_query.c.d
-
     decouverte = {
         decouverte_labels[v[0]]: v[1]
         for v in
-        db.session.query(decouverte_col, func.count('*')).group_by(decouverte_col).order_by(decouverte_col).all()
+        db.session.query(StatsDecouverte.decouverte, func.sum(StatsDecouverte.nombre))\
+            .group_by(StatsDecouverte.decouverte)\
+            .order_by(StatsDecouverte.decouverte)\
+            .all()
     }
-    total_reponses = Avis.query.count()
-    total_satisfaits = Avis.query.filter(Avis.recommandabilite > 8).count()
+    total_reponses = sum(s.reponses for s in jours)
+    total_satisfaits = sum(s.satisfaits for s in jours)
 
-    total_inscriptions = Inscription.query.count()
-    total_actifs = Inscription.active_query().count()
-    total_allergies = Inscription.active_query().filter(Inscription.population.any("allergie_pollens")).count()
-    total_pathologie_respiratoire = Inscription.active_query().filter(Inscription.population.any("pathologie_respiratoire")).count()
+    releve = next((s for s in reversed(jours) if s.allergies is not None), None)
+    # Les inscriptions sans date n’apparaissent dans aucun jour
+    total_inscriptions = sum(s.inscriptions for s in jours) + (releve and releve.inscriptions_sans_date or 0)
+    total_actifs = sum(s.inscriptions_actives for s in jours) + (releve and releve.inscriptions_actives_sans_date or 0)
+    total_allergies = releve.allergies if releve else 0
+    total_pathologie_respiratoire = releve.pathologie_respiratoire if releve else 0
 
-    ouvertures = []
-    api_instance = sib_api_v3_sdk.EmailCampaignsApi(sib)
-    try:
-        api_response = api_instance.get_email_campaigns(
-            end_date=datetime.now(),
-            start_date=(datetime.now() - timedelta(weeks=4)),
-            status='sent'
-        )
-        for campaign in api_response.campaigns:
-            try:
-                date_ = parse(campaign['name'])
-            except ParserError as e:
-                current_app.logger.info(e)
-                continue
-            stats = campaign['statistics']['globalStats']
-            if stats['delivered'] == 0:
-                continue
-            ouvertures.append(
-                (
-                    date_,
-                    (stats['uniqueViews']/stats['delivered'])*100
-                )
-            )
-    except ApiException as e:
-        current_app.logger.error(e)
-    ouvertures.sort(key=lambda v: v[0])
-    ouvertures = [(datetime.strftime(v[0], "%d/%m/%Y"), v[1]) for v in ouvertures]
+    ouvertures = [
+        (s.date.strftime("%d/%m/%Y"), s.taux_ouverture)
+        for s in jours
+        if s.taux_ouverture is not None and s.date >= date.today() - timedelta(weeks=4)
+    ]
     ouverture_veille = ouvertures[-1] if ouvertures else None
 
     to_return = {
@@ -121,6 +89,13 @@ def stats():
     }
 
     if not request.accept_mimetypes.accept_html:
-        return to_return
-    return render_template('stats.html', **to_return)
+        response = make_response(jsonify(to_return))
+    else:
+        response = make_response(render_template('stats.html', **to_return))
+    # Les agrégats ne changent qu’au passage de la tâche refresh_stats
+    response.add_etag()
+    response.cache_control.public = True
+    response.cache_control.max_age = int(os.getenv('STATS_CACHE_MAX_AGE', 300))
+    response.vary.add('Accept')
+    return response.make_conditional(request)
 
@@ -0,0 +1,12 @@
+from flask import current_app
+import click
+from .models import StatsJour, CampaignStats
+
+@current_app.cli.command('refresh-stats')
+@click.option('--full', is_flag=True, help="Recalcule tous les jours, pas seulement ceux touchés depuis le dernier passage")
+def refresh_stats(full):
+    CampaignStats.sync()
+    report = StatsJour.refresh(full=full)
+    click.echo(
+        f"{report['jours_modifies']}/{report['jours']} jours mis à jour en {report['duree']:.1f}s"
+    )
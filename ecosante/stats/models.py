@@ -0,0 +1,281 @@
+from ecosante.extensions import db, sib
+from ecosante.inscription.models import Inscription, SyncState
+from ecosante.avis.models import Avis
+from dataclasses import dataclass
+from datetime import date, datetime, timedelta
+from flask import current_app
+from sqlalchemy import func, or_, and_
+from sqlalchemy.dialects.postgresql import insert
+from dateutil.parser import parse, ParserError
+from time import perf_counter
+import os
+import sib_api_v3_sdk
+from sib_api_v3_sdk.rest import ApiException
+
+
+@dataclass
+class StatsJour(db.Model):
+    """Agrégats quotidiens lus par /stats, recalculés par la tâche refresh_stats"""
+    date: date = db.Column(db.Date, primary_key=True)
+    # Inscriptions du jour, et celles d’entre elles encore actives
+    inscriptions: int = db.Column(db.Integer, nullable=False, default=0)
+    inscriptions_actives: int = db.Column(db.Integer, nullable=False, default=0)
+    desinscriptions: int = db.Column(db.Integer, nullable=False, default=0)
+    # Avis donnés ce jour, et ceux avec une recommandabilité > 8
+    reponses: int = db.Column(db.Integer, nullable=False, default=0)
+    satisfaits: int = db.Column(db.Integer, nullable=False, default=0)
+    # Inscriptions actives allergiques / avec une pathologie respiratoire,
+    # relevées le jour même : l’historique de la colonne population n’est pas conservé
+    allergies: int = db.Column(db.Integer)
+    pathologie_respiratoire: int = db.Column(db.Integer)
+    # Inscriptions sans date_inscription (anciennes lignes), relevées le jour même
+    # pour être comptées dans les totaux
+    inscriptions_sans_date: int = db.Column(db.Integer)
+    inscriptions_actives_sans_date: int = db.Column(db.Integer)
+    # Taux d’ouverture de la newsletter envoyée ce jour
+    taux_ouverture: float = db.Column(db.Float)
+
+    @classmethod
+    def refresh(cls, today=None, full=False):
+        """Recalcule les agrégats des jours touchés depuis le dernier passage,
+        moins STATS_REFRESH_MARGIN_DAYS jours de marge, et n’écrit que les
+        lignes qui ont changé. Le premier passage, ou full=True, recalcule tout"""
+        start = perf_counter()
+        today = today or date.today()
+        state = SyncState.get('stats_jour')
+        since = None
+        if state.synced_at and not full:
+            since = state.synced_at.date() - timedelta(days=int(os.getenv('STATS_REFRESH_MARGIN_DAYS', 2)))
+
+        # Même définition que Inscription.active_query
+        est_active = and_(
+            or_(Inscription.deactivation_date == None, Inscription.deactivation_date > today),
+            Inscription.ville_insee.isnot(None)
+        )
+        # Une désinscription change inscriptions_actives du jour d’inscription :
+        # ces jours-là sont recalculés même s’ils précèdent since
+        jours_inscription = set()
+        if since:
+            jours_inscription = {
+                d for (d,) in db.session.query(Inscription.date_inscription)\
+                    .filter(or_(Inscription.date_inscription >= since, Inscription.deactivation_date >= since))\
+                    .filter(Inscription.date_inscription != None)\
+                    .distinct()
+            }
+
+        rows = dict()
+        def row(d):
+            if d not in rows:
+                rows[d] = dict()
+                if not since or d >= since or d in jours_inscription:
+                    rows[d].update(inscriptions=0, inscriptions_actives=0)
+                if not since or d >= since:
+                    rows[d].update(desinscriptions=0, reponses=0, satisfaits=0)
+            return rows[d]
+
+        query = db.session.query(
+                Inscription.date_inscription,
+                func.count(Inscription.id),
+                func.count(Inscription.id).filter(est_active)
+            )\
+            .filter(Inscription.date_inscription != None)
+        if since:
+            query = query.filter(Inscription.date_inscription.in_(jours_inscription))
+        for d, inscriptions, actives in query.group_by(Inscription.date_inscription):
+            row(d).update(inscriptions=inscriptions, inscriptions_actives=actives)
+
+        query = db.session.query(Inscription.deactivation_date, func.count(Inscription.id))\
+            .filter(Inscription.deactivation_date != None)
+        if since:
+            query = query.filter(Inscription.deactivation_date >= since)
+        for d, desinscriptions in query.group_by(Inscription.deactivation_date):
+            row(d)["desinscriptions"] = desinscriptions
+
+        query = db.session.query(
+                Avis.date,
+                func.count(Avis.id),
+                func.count(Avis.id).filter(Avis.recommandabilite > 8)
+            )\
+            .filter(Avis.date != None)
+        if since:
+            query = query.filter(Avis.date >= since)
+        for d, reponses, satisfaits in query.group_by(Avis.date):
+            row(d).update(reponses=reponses, satisfaits=satisfaits)
+
+        allergies, pathologie_respiratoire = Inscription.active_query()\
+            .with_entities(
+                func.count(Inscription.id).filter(Inscription.population.any("allergie_pollens")),
+                func.count(Inscription.id).filter(Inscription.population.any("pathologie_respiratoire"))
+            )\
+            .one()
+        row(today).update(allergies=allergies, pathologie_respiratoire=pathologie_respiratoire)
+
+        sans_date, actives_sans_date = db.session.query(
+                func.count(Inscription.id),
+                func.count(Inscription.id).filter(est_active)
+            )\
+            .filter(Inscription.date_inscription == None)\
+            .one()
+        row(today).update(inscriptions_sans_date=sans_date, inscriptions_actives_sans_date=actives_sans_date)
+
+        for d, taux in cls.ouvertures(today):
+            row(d)["taux_ouverture"] = taux
+
+        # Les jours recalculés déjà agrégés mais absents des requêtes repassent à zéro
+        query = cls.query
+        if since:
+            query = query.filter(or_(cls.date >= since, cls.date.in_(list(rows))))
+        existing = {s.date: s for s in query}
+        for d in existing:
+            row(d)
+        modifies = 0
+        for d, values in rows.items():
+            stats = existing.get(d)
+            if not stats:
+                stats = cls(date=d)
+                db.session.add(stats)
+            changed = {k: v for k, v in values.items() if getattr(stats, k) != v}
+            for k, v in changed.items():
+                setattr(stats, k, v)
+            modifies += bool(changed)
+
+        report = {
+            "jours": len(rows),
+            "jours_modifies": modifies,
+            "decouvertes_modifiees": StatsDecouverte.refresh(since),
+        }
+        state.synced_at = datetime.now().astimezone()
+        db.session.commit()
+        report["duree"] = perf_counter() - start
+        current_app.logger.info(f"Stats : {report}")
+        return report
+
+    @staticmethod
+    def ouvertures(today):
+        """(date, taux d’ouverture) des campagnes envoyées ces quatre dernières semaines"""
+        return [
+            (c.date, (c.unique_views/c.delivered)*100)
+            for c in CampaignStats.query\
+                .filter(CampaignStats.date >= today - timedelta(weeks=4))\
+                .filter(CampaignStats.delivered > 0)\
+                .order_by(CampaignStats.sent_date)
+        ]
+
+
+@dataclass
+class StatsDecouverte(db.Model):
+    """Nombre d’avis donnés chaque jour par réponse à « Comment avez-vous découvert… »"""
+    date: date = db.Column(db.Date, primary_key=True)
+    decouverte: str = db.Column(db.String, primary_key=True)
+    nombre: int = db.Column(db.Integer, nullable=False, default=0)
+
+    @classmethod
+    def refresh(cls, since=None):
+        """Recalcule les jours à partir de since, ou tous si since est None"""
+        query = db.session.query(
+                Avis.date.label('date'),
+                func.unnest(Avis.decouverte).label('d')
+            )\
+            .filter(Avis.date != None)
+        existing = cls.query
+        if since:
+            query = query.filter(Avis.date >= since)
+            existing = existing.filter(cls.date >= since)
+        decouverte_unnest_query = query.subquery()
+        counts = {
+            (d, decouverte): nombre
+            for d, decouverte, nombre in db.session.query(
+                decouverte_unnest_query.c.date,
+                decouverte_unnest_query.c.d,
+                func.count('*')
+            ).group_by(decouverte_unnest_query.c.date, decouverte_unnest_query.c.d)
+        }
+        modifies = 0
+        for stats in existing:
+            nombre = counts.pop((stats.date, stats.decouverte), 0)
+            if stats.nombre != nombre:
+                stats.nombre = nombre
+                modifies += 1
+        for (d, decouverte), nombre in counts.items():
+            db.session.add(cls(date=d, decouverte=decouverte, nombre=nombre))
+            modifies += 1
+        return modifies
+
+
+@dataclass
+class CampaignStats(db.Model):
+    """Copie locale des statistiques globales des campagnes SIB envoyées"""
+    campaign_id: int = db.Column(db.Integer, primary_key=True)
+    name: str = db.Column(db.String)
+    # Date de la newsletter, lue dans le nom de la campagne
+    date: date = db.Column(db.Date, index=True)
+    sent_date: datetime = db.Column(db.DateTime(timezone=True), index=True)
+    delivered: int = db.Column(db.Integer, nullable=False, default=0)
+    unique_views: int = db.Column(db.Integer, nullable=False, default=0)
+
+    @classmethod
+    def sync(cls, page_size=100):
+        """Récupère les campagnes envoyées depuis la dernière connue.
+        Les ouvertures continuent d’arriver après l’envoi : les campagnes des
+        CAMPAIGN_STATS_REFRESH_DAYS derniers jours sont relues et mises à jour"""
+        start = perf_counter()
+        now = datetime.now().astimezone()
+        last_sent_date = db.session.query(func.max(cls.sent_date)).scalar()
+        if last_sent_date:
+            start_date = last_sent_date - timedelta(days=int(os.getenv('CAMPAIGN_STATS_REFRESH_DAYS', 3)))
+        else:
+            start_date = now - timedelta(weeks=4)
+        api_instance = sib_api_v3_sdk.EmailCampaignsApi(sib)
+        rows = dict()
+        offset = 0
+        while True:
+            try:
+                api_response = api_instance.get_email_campaigns(
+                    status='sent',
+                    statistics='globalStats',
+                    start_date=start_date,
+                    end_date=now,
+                    limit=page_size,
+                    offset=offset,
+                    exclude_html_content=True
+                )
+            except ApiException as e:
+                current_app.logger.error(e)
+                break
+            campaigns = api_response.campaigns or []
+            rows.update((c['id'], cls.row(c)) for c in campaigns)
+            if len(campaigns) < page_size:
+                break
+            offset += page_size
+        if rows:
+            statement = insert(cls.__table__).values(list(rows.values()))
+            db.session.execute(
+                statement.on_conflict_do_update(
+                    index_elements=[cls.campaign_id],
+                    set_={
+                        k: statement.excluded[k]
+                        for k in ["name", "date", "sent_date", "delivered", "unique_views"]
+                    }
+                )
+            )
+            db.session.commit()
+        report = {"campaigns": len(rows), "duree": perf_counter() - start}
+        current_app.logger.info(f"Statistiques des campagnes : {report}")
+        return report
+
+    @staticmethod
+    def row(campaign):
+        try:
+            date_ = parse(campaign['name']).date()
+        except (ParserError, OverflowError) as e:
+            current_app.logger.info(e)
+            date_ = None
+        stats = campaign['statistics']['globalStats']
+        return {
+            "campaign_id": campaign['id'],
+            "name": campaign['name'],
+            "date": date_,
+            "sent_date": parse(campaign['sentDate']) if campaign.get('sentDate') else None,
+            "delivered": stats.get('delivered') or 0,
+            "unique_views": stats.get('uniqueViews') or 0,
+        }
@@ -0,0 +1,22 @@
+from ecosante.extensions import celery
+from ecosante.stats.models import StatsJour, CampaignStats
+from celery.schedules import crontab
+
+@celery.task
+def refresh_stats():
+    return StatsJour.refresh()
+
+@celery.task
+def sync_campaign_stats():
+    return CampaignStats.sync()
+
+@celery.on_after_configure.connect
+def setup_periodic_stats_tasks(sender, **kwargs):
+    sender.add_periodic_task(
+        crontab(minute='20', hour='*/1'),
+        sync_campaign_stats.s()
+    )
+    sender.add_periodic_task(
+        crontab(minute='30', hour='*/1'),
+        refresh_stats.s()
+    )
@@ -0,0 +1,45 @@
+from ecosante.extensions import celery, db
+from statistics import median
+from time import perf_counter, sleep
+from urllib.parse import urlparse
+
+
+@celery.task
+def ping():
+    return "pong"
+
+
+def database_activity():
+    db.session.execute("SELECT pg_stat_clear_snapshot()")
+    return db.session.execute("""
+        SELECT xact_commit + xact_rollback, numbackends
+        FROM pg_stat_database
+        WHERE datname = current_database()
+    """).first()
+
+
+def benchmark(n=100, timeout=30):
+    """Aller-retour de n tâches ping (envoi, exécution, lecture du résultat)
+    et transactions Postgres pendant ce temps, pour comparer les profils
+    Postgres (sqla+/db+) et Redis"""
+    before = database_activity()
+    db.session.commit()
+    latencies = []
+    for _ in range(n):
+        start = perf_counter()
+        ping.delay().get(timeout=timeout)
+        latencies.append(perf_counter() - start)
+    # Les statistiques de Postgres ne sont publiées qu’à intervalles réguliers
+    sleep(1)
+    after = database_activity()
+    db.session.commit()
+    latencies.sort()
+    return {
+        "broker": urlparse(celery.conf.broker_url).scheme,
+        "backend": urlparse(celery.conf.result_backend).scheme,
+        "taches": n,
+        "latence_mediane": median(latencies),
+        "latence_p95": latencies[int(0.95*(n - 1))],
+        "transactions_par_tache": (after[0] - before[0])/n,
+        "connexions": after[1],
+    }
@@ -0,0 +1,16 @@
+from flask import current_app
+import click
+from .benchmark import benchmark
+
+@current_app.cli.command('benchmark-celery')
+@click.option('--n', default=100)
+def benchmark_celery(n):
+    """À lancer avec un worker démarré sur la même configuration"""
+    report = benchmark(n)
+    click.echo(
+        f"{report['broker']}/{report['backend']} : {report['taches']} tâches, "
+        f"latence médiane {report['latence_mediane']*1000:.1f}ms, "
+        f"p95 {report['latence_p95']*1000:.1f}ms, "
+        f"{report['transactions_par_tache']:.1f} transactions Postgres par tâche, "
+        f"{report['connexions']} connexions"
+    )
@@ -1,20 +1,95 @@
 import sib_api_v3_sdk
-from ecosante.extensions import celery, sib
-from time import sleep
+from sib_api_v3_sdk.rest import ApiException
+from collections import Counter
+from datetime import datetime
+from flask import current_app
+from ecosante.extensions import celery, sib, db
+from ecosante.inscription.models import Inscription
+from ecosante.newsletter.tasks.import_in_sb import wait_for_process
+from ecosante.utils.progress import ProgressReporter
+from ecosante.utils.rate_limit import call_with_retry
+import json
+import os
+
+@celery.task(bind=True)
+def inscription_patients_task(self, nom_medecin, emails):
+    """Crée les contacts des patients en un seul import SIB, puis leur envoie
+    l’invitation par lots. Renvoie le résultat de chaque adresse :
+    deja_inscrit, envoye, erreur_contact ou erreur_envoi"""
+    emails = list(dict.fromkeys(e.strip() for e in emails if e and e.strip()))
+    resultats = {
+        mail: "deja_inscrit"
+        for (mail,) in db.session.query(Inscription.mail).filter(Inscription.mail.in_(emails))
+    }
+    a_inviter = [e for e in emails if e not in resultats]
+    chunk_size = int(os.getenv('SIB_TRANSACTIONAL_CHUNK_SIZE', 50))
+    chunks = [a_inviter[i:i+chunk_size] for i in range(0, len(a_inviter), chunk_size)]
+    reporter = ProgressReporter(self, 1 + len(chunks))
+    reporter.report(f"Création de {len(a_inviter)} contacts ({len(resultats)} déjà inscrits)", force=True)
+
+    erreurs_contact = create_contacts(a_inviter, nom_medecin)
+    resultats.update((mail, "erreur_contact") for mail in erreurs_contact)
+    reporter.advance(1, "Envoi des invitations", force=True)
 
-@celery.task
-def inscription_patients_task(nom_medecin, emails):
-    contacts_api = sib_api_v3_sdk.ContactsApi(sib)
     transac_api = sib_api_v3_sdk.TransactionalEmailsApi(sib)
-    for email in emails:
-        contacts_api.create_contact(
-            sib_api_v3_sdk.CreateContact(email=email)
-        )
-        sleep(0.1)
+    for i, chunk in enumerate(chunks, 1):
+        chunk = [mail for mail in chunk if not mail in erreurs_contact]
+        if chunk:
+            # Un message par patient : les adresses ne sont pas visibles des autres
+            try:
+                call_with_retry(
+                    transac_api.send_transac_email,
+                    sib_api_v3_sdk.SendSmtpEmail(
+                        template_id=int(os.getenv('SIB_PATIENTS_TEMPLATE_ID', 487)),
+                        params={"NOM_MEDECIN": nom_medecin},
+                        message_versions=[{"to": [{"email": mail}]} for mail in chunk]
+                    )
+                )
+                resultats.update((mail, "envoye") for mail in chunk)
+            except ApiException as e:
+                current_app.logger.error(f"Erreur lors de l’envoi de {len(chunk)} invitations : {e}")
+                resultats.update((mail, "erreur_envoi") for mail in chunk)
+        reporter.advance(1, f"Envoi des invitations {i}/{len(chunks)}")
 
-    send_smtp_email = sib_api_v3_sdk.SendSmtpEmail(
-        to=[sib_api_v3_sdk.SendSmtpEmailTo(email=email) for email in emails],
-        template_id=487,
-        params={"NOM_MEDECIN": nom_medecin}
-    )
-    transac_api.send_transac_email(send_smtp_email=send_smtp_email)
\ No newline at end of file
+    compte = Counter(resultats.values())
+    current_app.logger.info(f"Inscription des patients de {nom_medecin} : {dict(compte)}")
+    return {
+        "state": "SUCCESS",
+        "progress": 100,
+        "details": ", ".join(f"{n} {resultat}" for resultat, n in compte.items()),
+        "resultats": resultats
+    }
+
+def create_contacts(emails, nom_medecin):
+    """Un seul job d’import SIB, suivi jusqu’à sa fin. S’il échoue, on se
+    rabat sur un create_contact par adresse. Renvoie les adresses en échec"""
+    if not emails:
+        return set()
+    contacts_api = sib_api_v3_sdk.ContactsApi(sib)
+    try:
+        r = contacts_api.import_contacts(
+            sib_api_v3_sdk.RequestContactImport(
+                json_body=[{"email": mail} for mail in emails],
+                new_list=sib_api_v3_sdk.RequestContactImportNewList(
+                    list_name=f'{datetime.now()} - patients {nom_medecin}',
+                    folder_id=int(os.getenv('SIB_FOLDERID', 5))
+                ),
+                update_existing_contacts=False,
+                empty_contacts_attributes=False
+            )
+        )
+        if wait_for_process(r.process_id):
+            return set()
+        current_app.logger.error(f"Import process {r.process_id} did not complete, creating contacts one by one")
+    except ApiException as e:
+        current_app.logger.error(f"Error importing {len(emails)} contacts, creating contacts one by one")
+        current_app.logger.error(e)
+    erreurs = set()
+    for mail in emails:
+        try:
+            call_with_retry(contacts_api.create_contact, sib_api_v3_sdk.CreateContact(email=mail))
+        except ApiException as e:
+            if json.loads(e.body or '{}').get('code') != 'duplicate_parameter':
+                current_app.logger.error(f"Unable to create_contact {mail}: {e}")
+                erreurs.add(mail)
+    return erreurs
@@ -0,0 +1,80 @@
+from datetime import datetime, timedelta
+from threading import Lock
+from time import monotonic
+
+
+class TTLCache:
+    """Cache en mémoire, propre à chaque processus, dont les valeurs
+    expirent au bout de `ttl` secondes"""
+
+    def __init__(self, ttl, maxsize=None):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.values = dict()
+        self.lock = Lock()
+        self.key_locks = dict()
+
+    def get(self, key):
+        with self.lock:
+            if not key in self.values:
+                return None
+            expires, value = self.values[key]
+            if expires < monotonic():
+                del self.values[key]
+                return None
+            return value
+
+    def set(self, key, value, ttl=None):
+        with self.lock:
+            if self.maxsize and len(self.values) >= self.maxsize:
+                self.purge()
+            self.values[key] = (monotonic() + (ttl if ttl is not None else self.ttl), value)
+        return value
+
+    def get_or_set(self, key, compute, ttl=None):
+        """Les appels concurrents pour une même clé absente attendent
+        le résultat d’un seul appel à compute()"""
+        value = self.get(key)
+        if value is not None:
+            return value
+        with self.lock:
+            key_lock = self.key_locks.setdefault(key, Lock())
+        try:
+            with key_lock:
+                value = self.get(key)
+                if value is None:
+                    value = self.set(key, compute(), ttl)
+                return value
+        finally:
+            with self.lock:
+                self.key_locks.pop(key, None)
+
+    def purge(self):
+        # Appelée avec self.lock : on retire les valeurs expirées, puis
+        # celles qui expirent le plus tôt si le cache est encore plein
+        now = monotonic()
+        for key in [k for k, (expires, _) in self.values.items() if expires < now]:
+            del self.values[key]
+        while len(self.values) >= self.maxsize:
+            del self.values[min(self.values, key=lambda k: self.values[k][0])]
+
+    def clear(self, *args, **kwargs):
+        with self.lock:
+            self.values.clear()
+
+
+def seconds_until(hours, now=None):
+    """Secondes jusqu’à la prochaine heure pleine de `hours`, ou minuit"""
+    now = now or datetime.now()
+    midnight = datetime.combine(now.date() + timedelta(days=1), datetime.min.time())
+    next_times = [now.replace(hour=h, minute=0, second=0, microsecond=0) for h in hours]
+    next_time = min([t for t in next_times if t > now] + [midnight])
+    return int((next_time - now).total_seconds()) + 1
+
+
+def last_time(hours, now=None):
+    """Dernière heure pleine de `hours` déjà passée aujourd’hui, ou minuit"""
+    now = now or datetime.now()
+    midnight = datetime.combine(now.date(), datetime.min.time())
+    past_times = [now.replace(hour=h, minute=0, second=0, microsecond=0) for h in hours]
+    return max([t for t in past_times if t <= now] + [midnight])
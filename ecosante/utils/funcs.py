@@ -11,6 +11,22 @@ def generate_line(line):
     stringio.close()
     return v
 
+def generate_lines(lines, chunk_size=64*1024):
+    """Comme generate_line mais avec un seul writer pour toutes les lignes,
+    renvoyées par morceaux d’environ `chunk_size` caractères"""
+    stringio = StringIO()
+    writer = csv.writer(stringio)
+    for line in lines:
+        writer.writerow(line)
+        if stringio.tell() >= chunk_size:
+            yield stringio.getvalue()
+            stringio.seek(0)
+            stringio.truncate(0)
+    v = stringio.getvalue()
+    stringio.close()
+    if v:
+        yield v
+
 def convert_boolean_to_oui_non(value):
     return "Oui" if value else "Non"
 
@@ -0,0 +1,51 @@
+from time import monotonic
+import os
+
+
+class ProgressReporter:
+    """Regroupe les task.update_state : avec le backend `db+` chaque appel
+    est une écriture en base. Une mise à jour n’est envoyée que si
+    `interval` secondes se sont écoulées ou si la progression a avancé
+    d’au moins `step` points. Les mises à jour `force` sont toujours envoyées.
+    Le format de meta ({"progress", "details", ...}) est celui lu par
+    get_task_status.js. `task_id` permet de publier l’avancement sous l’id
+    d’une autre tâche, celle suivie par la page de progression"""
+
+    def __init__(self, task, total=0, interval=None, step=None, task_id=None):
+        self.task = task
+        self.task_id = task_id
+        self.total = total
+        self.done = 0
+        self.interval = interval if interval is not None else float(os.getenv('PROGRESS_INTERVAL', 2))
+        self.step = step if step is not None else float(os.getenv('PROGRESS_STEP', 1))
+        self.last_time = None
+        self.last_progress = None
+
+    @property
+    def progress(self):
+        return (self.done/self.total)*100 if self.total else 0
+
+    def advance(self, n=1, details=None, force=False, **meta):
+        self.done += n
+        return self.report(details, force=force, **meta)
+
+    def report(self, details, force=False, progress=None, **meta):
+        progress = self.progress if progress is None else progress
+        now = monotonic()
+        if not force and self.last_time is not None\
+            and now - self.last_time < self.interval\
+            and abs(progress - self.last_progress) < self.step:
+            return False
+        kwargs = {"task_id": self.task_id} if self.task_id else {}
+        self.task.update_state(
+            state='STARTED',
+            meta={
+                "progress": progress,
+                "details": details,
+                **meta
+            },
+            **kwargs
+        )
+        self.last_time = now
+        self.last_progress = progress
+        return True
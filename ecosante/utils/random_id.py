@@ -0,0 +1,7 @@
+import secrets
+
+# Même alphabet que la fonction SQL get_random_string
+ALPHABET = '0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz'
+
+def random_id(length=8):
+    return ''.join(secrets.choice(ALPHABET) for _ in range(length))
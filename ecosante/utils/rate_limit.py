@@ -0,0 +1,45 @@
+from threading import Lock
+from time import monotonic, sleep
+import random
+from sib_api_v3_sdk.rest import ApiException
+
+
+class TokenBucket:
+    """Limite le nombre d’appels par seconde, partagé entre plusieurs threads"""
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or max(1, rate)
+        self.tokens = self.capacity
+        self.last = monotonic()
+        self.lock = Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.last) * self.rate)
+                self.last = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            sleep(wait)
+
+
+def is_retryable(e: ApiException):
+    return e.status == 429 or (e.status or 0) >= 500
+
+
+def call_with_retry(f, *args, bucket=None, max_retries=5, base_delay=0.5, **kwargs):
+    """Appelle l’API SIB `f`, en réessayant avec un délai exponentiel
+    aléatoire en cas de 429 ou d’erreur 5xx"""
+    for attempt in range(max_retries + 1):
+        if bucket:
+            bucket.acquire()
+        try:
+            return f(*args, **kwargs)
+        except ApiException as e:
+            if attempt == max_retries or not is_retryable(e):
+                raise e
+            sleep(random.uniform(0, base_delay * 2**attempt))
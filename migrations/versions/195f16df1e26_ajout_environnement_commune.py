@@ -0,0 +1,32 @@
+"""Ajout environnement_commune
+
+Revision ID: 195f16df1e26
+Revises: 1ef233085742
+Create Date: 2021-05-12 15:02:18.660943
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '195f16df1e26'
+down_revision = '1ef233085742'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('environnement_commune',
+    sa.Column('insee', sa.String(), nullable=False),
+    sa.Column('date', sa.Date(), nullable=False),
+    sa.Column('forecast', sa.JSON(), nullable=True),
+    sa.Column('episodes', sa.JSON(), nullable=True),
+    sa.Column('raep', sa.JSON(), nullable=True),
+    sa.Column('updated_at', sa.DateTime(), nullable=False),
+    sa.PrimaryKeyConstraint('insee', 'date')
+    )
+
+
+def downgrade():
+    op.drop_table('environnement_commune')
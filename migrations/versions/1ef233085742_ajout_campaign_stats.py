@@ -0,0 +1,36 @@
+"""Ajout campaign_stats
+
+Revision ID: 1ef233085742
+Revises: b279bab5adc3
+Create Date: 2021-05-11 09:41:27.503118
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '1ef233085742'
+down_revision = 'b279bab5adc3'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('campaign_stats',
+    sa.Column('campaign_id', sa.Integer(), nullable=False),
+    sa.Column('name', sa.String(), nullable=True),
+    sa.Column('date', sa.Date(), nullable=True),
+    sa.Column('sent_date', sa.DateTime(timezone=True), nullable=True),
+    sa.Column('delivered', sa.Integer(), nullable=False),
+    sa.Column('unique_views', sa.Integer(), nullable=False),
+    sa.PrimaryKeyConstraint('campaign_id')
+    )
+    op.create_index(op.f('ix_campaign_stats_date'), 'campaign_stats', ['date'], unique=False)
+    op.create_index(op.f('ix_campaign_stats_sent_date'), 'campaign_stats', ['sent_date'], unique=False)
+
+
+def downgrade():
+    op.drop_index(op.f('ix_campaign_stats_sent_date'), table_name='campaign_stats')
+    op.drop_index(op.f('ix_campaign_stats_date'), table_name='campaign_stats')
+    op.drop_table('campaign_stats')
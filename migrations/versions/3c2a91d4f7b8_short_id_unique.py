@@ -0,0 +1,35 @@
+"""Contrainte d’unicité sur newsletter.short_id
+
+Revision ID: 3c2a91d4f7b8
+Revises: 195f16df1e26
+Create Date: 2021-05-17 10:12:41.203518
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = '3c2a91d4f7b8'
+down_revision = '195f16df1e26'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Index construit sans bloquer les écritures sur newsletter, puis
+    # rattaché à la contrainte. Un index invalide laissé par une tentative
+    # interrompue est d’abord supprimé
+    with op.get_context().autocommit_block():
+        op.execute('DROP INDEX CONCURRENTLY IF EXISTS newsletter_short_id_key')
+        op.create_index(
+            'newsletter_short_id_key',
+            'newsletter',
+            ['short_id'],
+            unique=True,
+            postgresql_concurrently=True
+        )
+    op.execute('ALTER TABLE newsletter ADD CONSTRAINT newsletter_short_id_key UNIQUE USING INDEX newsletter_short_id_key')
+
+
+def downgrade():
+    op.drop_constraint('newsletter_short_id_key', 'newsletter', type_='unique')
@@ -0,0 +1,44 @@
+"""Index de la table newsletter
+
+Revision ID: 5f0b7c3e9d21
+Revises: 8d4e6b1f2a3c
+Create Date: 2021-05-19 11:03:52.871245
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5f0b7c3e9d21'
+down_revision = '8d4e6b1f2a3c'
+branch_labels = None
+depends_on = None
+
+
+INDEXES = [
+    ('ix_newsletter_inscription_id_date', ['inscription_id', 'date'], None),
+    ('ix_newsletter_date_avis', ['date'], 'avis IS NOT NULL'),
+    ('ix_newsletter_recommandation_id_date_appliquee', ['recommandation_id', 'date'], 'appliquee IS NOT NULL'),
+]
+
+
+def upgrade():
+    # Construits sans bloquer les écritures sur newsletter. Un index
+    # invalide laissé par une tentative interrompue est d’abord supprimé
+    with op.get_context().autocommit_block():
+        for name, columns, where in INDEXES:
+            op.execute(f'DROP INDEX CONCURRENTLY IF EXISTS {name}')
+            op.create_index(
+                name,
+                'newsletter',
+                columns,
+                postgresql_where=sa.text(where) if where else None,
+                postgresql_concurrently=True
+            )
+
+
+def downgrade():
+    with op.get_context().autocommit_block():
+        for name, _, _ in reversed(INDEXES):
+            op.drop_index(name, table_name='newsletter', postgresql_concurrently=True)
@@ -0,0 +1,134 @@
+"""generate_random_id sans verrou consultatif
+
+Revision ID: 8d4e6b1f2a3c
+Revises: 3c2a91d4f7b8
+Create Date: 2021-05-18 09:41:07.512334
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = '8d4e6b1f2a3c'
+down_revision = '3c2a91d4f7b8'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Les identifiants existants sont conservés : l’ancienne fonction
+    # garantissait déjà leur unicité, la contrainte ne fait que la vérifier.
+    # Index construit sans bloquer les écritures sur inscription, puis
+    # rattaché à la contrainte. Un index invalide laissé par une tentative
+    # interrompue est d’abord supprimé
+    with op.get_context().autocommit_block():
+        op.execute('DROP INDEX CONCURRENTLY IF EXISTS inscription_uid_key')
+        op.create_index(
+            'inscription_uid_key',
+            'inscription',
+            ['uid'],
+            unique=True,
+            postgresql_concurrently=True
+        )
+    op.execute('ALTER TABLE inscription ADD CONSTRAINT inscription_uid_key UNIQUE USING INDEX inscription_uid_key')
+    op.execute("""
+CREATE OR REPLACE FUNCTION get_random_string(
+        IN string_length integer,
+        IN possible_chars TEXT DEFAULT '0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz'
+    ) RETURNS text
+    LANGUAGE sql
+    VOLATILE
+    AS $$
+    SELECT string_agg(substr(possible_chars, 1 + floor(random() * length(possible_chars))::int, 1), '')
+    FROM generate_series(1, string_length)
+$$;
+
+CREATE OR REPLACE FUNCTION generate_random_id(
+    IN table_schema   TEXT,
+    IN table_name     TEXT,
+    IN column_name    TEXT,
+    IN string_length  INTEGER,
+    IN possible_chars TEXT DEFAULT '0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz'
+) returns text
+    LANGUAGE plpgsql
+    AS $$
+DECLARE
+    v_random_id text;
+    v_exists    bool;
+    v_sql       text := format( 'SELECT EXISTS (SELECT 1 FROM %I.%I WHERE %I = $1)', table_schema, table_name, column_name );
+BEGIN
+    -- La recherche passe par l’index de la contrainte d’unicité de la colonne.
+    -- Pas de verrou : deux insertions concurrentes qui tireraient le même
+    -- identifiant sont départagées par la contrainte
+    LOOP
+        v_random_id := get_random_string( string_length, possible_chars );
+        EXECUTE v_sql INTO v_exists USING v_random_id;
+        EXIT WHEN NOT v_exists;
+    END LOOP;
+    RETURN v_random_id;
+END;
+$$
+STRICT
+SET search_path TO public
+;
+    """)
+
+
+def downgrade():
+    op.execute("""
+CREATE OR REPLACE FUNCTION get_random_string(
+        IN string_length integer,
+        IN possible_chars TEXT DEFAULT '0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz'
+    ) RETURNS text
+    LANGUAGE plpgsql
+    AS $$
+DECLARE
+    output TEXT = '';
+    i INT4;
+    pos INT4;
+BEGIN
+    FOR i IN 1..string_length LOOP
+        pos := 1 + cast( random() * ( length(possible_chars) - 1) as INT4 );
+        output := output || substr(possible_chars, pos, 1);
+    END LOOP;
+    RETURN output;
+END;
+$$;
+
+create or replace function generate_random_id(
+    IN table_schema   TEXT,
+    IN table_name     TEXT,
+    IN column_name    TEXT,
+    IN string_length  INTEGER,
+    IN possible_chars TEXT DEFAULT '0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz'
+) returns text
+    LANGUAGE plpgsql
+    AS $$
+DECLARE
+    v_random_id   text;
+    v_temp        text;
+    v_length      int4   :=  string_length;
+    v_sql         text;
+    v_advisory_1  int4 := hashtext( format('%I:%I:%I', table_schema, table_name, column_name) );
+    v_advisory_2  int4;
+    v_advisory_ok bool;
+BEGIN
+    v_sql := format( 'SELECT %I FROM %I.%I WHERE %I = $1', column_name, table_schema, table_name, column_name );
+    LOOP
+        v_random_id := get_random_string( v_length, possible_chars );
+        v_advisory_2 := hashtext( v_random_id );
+        v_advisory_ok := pg_try_advisory_xact_lock( v_advisory_1, v_advisory_2 );
+        IF v_advisory_ok THEN
+            EXECUTE v_sql INTO v_temp USING v_random_id;
+            exit when v_temp is null;
+        END IF;
+        v_length := v_length + 1;
+    END LOOP;
+    return v_random_id;
+END;
+$$
+STRICT
+SET search_path TO public
+;
+    """)
+    op.drop_constraint('inscription_uid_key', 'inscription', type_='unique')
@@ -0,0 +1,28 @@
+"""Ajout sync_state
+
+Revision ID: a7e3c5d90b14
+Revises: 5f0b7c3e9d21
+Create Date: 2021-05-20 16:27:03.448119
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a7e3c5d90b14'
+down_revision = '5f0b7c3e9d21'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('sync_state',
+        sa.Column('name', sa.String(), nullable=False),
+        sa.Column('synced_at', sa.DateTime(timezone=True), nullable=True),
+        sa.PrimaryKeyConstraint('name')
+    )
+
+
+def downgrade():
+    op.drop_table('sync_state')
@@ -0,0 +1,42 @@
+"""Ajout tables stats
+
+Revision ID: b279bab5adc3
+Revises: c313885f2bee
+Create Date: 2021-05-10 10:12:41.215804
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b279bab5adc3'
+down_revision = 'c313885f2bee'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('stats_jour',
+    sa.Column('date', sa.Date(), nullable=False),
+    sa.Column('inscriptions', sa.Integer(), nullable=False),
+    sa.Column('inscriptions_actives', sa.Integer(), nullable=False),
+    sa.Column('desinscriptions', sa.Integer(), nullable=False),
+    sa.Column('reponses', sa.Integer(), nullable=False),
+    sa.Column('satisfaits', sa.Integer(), nullable=False),
+    sa.Column('allergies', sa.Integer(), nullable=True),
+    sa.Column('pathologie_respiratoire', sa.Integer(), nullable=True),
+    sa.Column('taux_ouverture', sa.Float(), nullable=True),
+    sa.PrimaryKeyConstraint('date')
+    )
+    op.create_table('stats_decouverte',
+    sa.Column('date', sa.Date(), nullable=False),
+    sa.Column('decouverte', sa.String(), nullable=False),
+    sa.Column('nombre', sa.Integer(), nullable=False),
+    sa.PrimaryKeyConstraint('date', 'decouverte')
+    )
+
+
+def downgrade():
+    op.drop_table('stats_decouverte')
+    op.drop_table('stats_jour')
@@ -0,0 +1,26 @@
+"""Inscriptions sans date dans stats_jour
+
+Revision ID: e2b8d4f61c07
+Revises: a7e3c5d90b14
+Create Date: 2021-05-21 10:04:37.215318
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e2b8d4f61c07'
+down_revision = 'a7e3c5d90b14'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('stats_jour', sa.Column('inscriptions_sans_date', sa.Integer(), nullable=True))
+    op.add_column('stats_jour', sa.Column('inscriptions_actives_sans_date', sa.Integer(), nullable=True))
+
+
+def downgrade():
+    op.drop_column('stats_jour', 'inscriptions_actives_sans_date')
+    op.drop_column('stats_jour', 'inscriptions_sans_date')
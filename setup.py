@@ -46,6 +46,7 @@ setup(
     keywords='air quality aasqa atmo iqa',
     packages=find_packages(),
     include_package_data=True,
+    package_data={'ecosante.inscription': ['data/*.json.gz']},
     zip_safe=False,
     install_requires=DEPENDENCIES,
     extras_require={
@@ -54,7 +55,8 @@ setup(
             'pytest',
             'pytest-alembic',
             'pytest-flask-sqlalchemy',
-            'pytest-postgresql'
+            'pytest-postgresql',
+            'fakeredis[lua]'
         ]
     },
     setup_requires=['pytest-runner'],
@@ -3,6 +3,9 @@ import pytest
 import os
 import sqlalchemy as sa
 import concurrent.futures as cf
+from threading import Thread
+from contextlib import contextmanager
+from sqlalchemy import event
 import flask_migrate
 from ecosante import create_app
 from indice_pollution import create_app as create_app_indice_pollution
@@ -48,4 +51,71 @@ def app(request):
 
 @pytest.fixture(scope='function')
 def _db(app):
-    return app.extensions['sqlalchemy'].db
\ No newline at end of file
+    return app.extensions['sqlalchemy'].db
+
+@pytest.fixture
+def sib_stub(app):
+    from ecosante.extensions import sib
+    from sib_stub import SibStub
+    stub = SibStub()
+    stub.start()
+    previous_host = sib.configuration.host
+    sib.configuration.host = stub.host
+    yield stub
+    sib.configuration.host = previous_host
+    stub.stop()
+
+@pytest.fixture
+def commune_index(monkeypatch):
+    """Remplace l’index local des communes par celles passées à la
+    fonction renvoyée, au format de geo.api.gouv.fr"""
+    from ecosante.inscription import communes
+    def set_index(*liste):
+        index = communes.CommuneIndex({c['code']: c for c in liste})
+        monkeypatch.setattr(communes, "_index", index)
+        return index
+    return set_index
+
+@pytest.fixture
+def capture_sql():
+    """Gestionnaire de contexte qui relève les (requête, paramètres)
+    exécutés sur `target`, le moteur de l’application par défaut"""
+    from ecosante.extensions import db
+    @contextmanager
+    def capture(target=None):
+        target = target or db.engine
+        statements = []
+        def listener(conn, cursor, statement, parameters, context, executemany):
+            statements.append((statement, parameters))
+        event.listen(target, "before_cursor_execute", listener)
+        try:
+            yield statements
+        finally:
+            event.remove(target, "before_cursor_execute", listener)
+    return capture
+
+@pytest.fixture
+def celery_redis(monkeypatch):
+    """Profil Redis de Celery sur un faux serveur Redis local.
+    À demander avant la fixture app, qui lit CELERY_PROFILE et REDIS_URL"""
+    fakeredis = pytest.importorskip("fakeredis")
+    from ecosante.extensions import celery
+    server = fakeredis.TcpFakeServer(('127.0.0.1', 0), server_type="redis")
+    server.daemon_threads = True
+    Thread(target=server.serve_forever, daemon=True).start()
+    host, port = server.server_address
+    url = f"redis://{host}:{port}/0"
+    monkeypatch.setenv('REDIS_URL', url)
+    monkeypatch.setenv('CELERY_PROFILE', 'redis')
+    monkeypatch.delenv('CELERY_BROKER_URL', raising=False)
+    monkeypatch.delenv('CELERY_RESULT_BACKEND', raising=False)
+    def reset_connections():
+        # Oublie les connexions déjà ouvertes avec une autre configuration
+        celery._pool = None
+        celery.amqp._producer_pool = None
+        celery.__dict__.pop('backend', None)
+    reset_connections()
+    yield url
+    reset_connections()
+    server.shutdown()
+    server.server_close()
@@ -0,0 +1,112 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Lock, Thread
+from urllib.parse import unquote, urlparse, parse_qs
+import json
+import re
+
+
+class SibStub:
+    """Faux serveur Sendinblue local : enregistre les appels reçus
+    pour pouvoir tester (et chronométrer) les envois sans réseau"""
+
+    def __init__(self):
+        self.imports = []
+        self.updates = []
+        self.fail_imports = False
+        # Nombre de réponses 429 à renvoyer avant d’accepter les mises à jour
+        self.rate_limited_updates = 0
+        # Campagnes renvoyées par GET /v3/emailCampaigns
+        self.campaigns = []
+        self.campaign_queries = []
+        # Emails transactionnels envoyés
+        self.emails = []
+        # Contacts créés un par un
+        self.contacts = []
+        # Contacts renvoyés par GET /v3/contacts, avec emailBlacklisted et modifiedAt
+        self.contact_list = []
+        self.contact_queries = []
+        self.next_id = 1
+        self.lock = Lock()
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def read_json(self):
+                length = int(self.headers.get('Content-Length') or 0)
+                return json.loads(self.rfile.read(length) or b'null')
+
+            def respond(self, status, body=None):
+                payload = json.dumps(body).encode() if body is not None else b''
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def do_POST(self):
+                body = self.read_json()
+                if self.path == '/v3/contacts/import':
+                    if stub.fail_imports:
+                        return self.respond(400, {"code": "invalid_parameter", "message": "stub"})
+                    stub.imports.append(body)
+                    return self.respond(202, {"processId": stub.new_id()})
+                if self.path == '/v3/contacts':
+                    if body['email'] in stub.contacts:
+                        return self.respond(400, {"code": "duplicate_parameter", "message": "Contact already exist"})
+                    stub.contacts.append(body['email'])
+                    return self.respond(201, {"id": stub.new_id()})
+                if self.path == '/v3/contacts/lists':
+                    return self.respond(201, {"id": stub.new_id()})
+                if self.path == '/v3/smtp/email':
+                    stub.emails.append(body)
+                    return self.respond(201, {"messageId": f"<{stub.new_id()}@stub>"})
+                self.respond(404, {"code": "not_found", "message": self.path})
+
+            def do_PUT(self):
+                body = self.read_json()
+                if self.path.startswith('/v3/contacts/'):
+                    with stub.lock:
+                        if stub.rate_limited_updates > 0:
+                            stub.rate_limited_updates -= 1
+                            return self.respond(429, {"code": "too_many_requests", "message": "stub"})
+                    stub.updates.append((unquote(self.path[len('/v3/contacts/'):]), body))
+                    return self.respond(204)
+                self.respond(404, {"code": "not_found", "message": self.path})
+
+            def do_GET(self):
+                if self.path.split('?')[0] == '/v3/emailCampaigns':
+                    stub.campaign_queries.append(parse_qs(urlparse(self.path).query))
+                    return self.respond(200, {"campaigns": stub.campaigns, "count": len(stub.campaigns)})
+                if self.path.split('?')[0] == '/v3/contacts':
+                    query = parse_qs(urlparse(self.path).query)
+                    stub.contact_queries.append(query)
+                    contacts = [
+                        c for c in stub.contact_list
+                        if not 'modifiedSince' in query or c['modifiedAt'] >= query['modifiedSince'][0]
+                    ]
+                    offset, limit = int(query.get('offset', [0])[0]), int(query.get('limit', [50])[0])
+                    return self.respond(200, {"contacts": contacts[offset:offset+limit], "count": len(contacts)})
+                m = re.match(r'^/v3/processes/(\d+)$', self.path)
+                if m:
+                    return self.respond(200, {"id": int(m.group(1)), "status": "completed", "name": "import"})
+                self.respond(404, {"code": "not_found", "message": self.path})
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.thread = Thread(target=self.server.serve_forever, daemon=True)
+
+    def new_id(self):
+        self.next_id += 1
+        return self.next_id
+
+    @property
+    def host(self):
+        return f'http://127.0.0.1:{self.server.server_port}/v3'
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
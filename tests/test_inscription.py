@@ -1,5 +1,8 @@
 from ecosante.inscription.models import Inscription
+from ecosante.inscription import communes
+from ecosante.inscription.communes import CommuneIndex
 from datetime import date, datetime, timedelta
+import pytest
 
 def premiere_etape(client):
     mail = f'dodo-{int(datetime.timestamp(datetime.now()))}@beta.gouv.fr'
@@ -186,4 +189,301 @@ def test_deactivate_accounts(db_session):
     assert db_session.query(Inscription).count() == 4
     assert db_session.query(Inscription).filter(Inscription.mail==None).count() == 1
     assert Inscription.deactivate_accounts() == 1
-    assert db_session.query(Inscription).filter(Inscription.mail==None).count() == 2
\ No newline at end of file
+    assert db_session.query(Inscription).filter(Inscription.mail==None).count() == 2
+
+def test_commune_index(tmp_path, monkeypatch, commune_index):
+    path = str(tmp_path / "communes.json.gz")
+    CommuneIndex.write([{
+        "code": "53130",
+        "nom": "Laval",
+        "codesPostaux": ["53000"],
+        "centre": {"type": "Point", "coordinates": [-0.7597, 48.0609]},
+        "region": {"code": "52", "nom": "Pays de la Loire"},
+        "departement": {"code": "53", "nom": "Mayenne"}
+    }], path, "test")
+    index = CommuneIndex.load(path)
+    assert index.version == "test"
+    assert "53130" in index
+    assert index.get("53144") is None
+
+    monkeypatch.setattr(communes, "_index", index)
+    monkeypatch.setattr(communes, "fetch", lambda insee: pytest.fail("Appel réseau"))
+    i = Inscription(ville_insee="53130")
+    assert i.ville_nom == "Laval"
+    assert i.ville_codes_postaux == ["53000"]
+    assert i.region_name == "Pays de la Loire"
+    assert i.departement["nom"] == "Mayenne"
+
+    i._cache_api_commune = {"nom": "Laval"}
+    assert i.region_name == "Pays de la Loire"
+
+    # Sans index local, on se rabat sur geo.api.gouv.fr
+    commune_index()
+    monkeypatch.setattr(communes, "fetch", lambda insee: {"code": insee, "nom": "Laval"})
+    i._cache_api_commune = None
+    assert i.ville_nom == "Laval"
+    assert i.region_name is None
+
+def test_refresh_cache_api_commune(db_session, monkeypatch, commune_index):
+    laval = {
+        "code": "53130",
+        "nom": "Laval",
+        "codesPostaux": ["53000"],
+        "centre": {"type": "Point", "coordinates": [-0.7597, 48.0609]},
+        "region": {"code": "52", "nom": "Pays de la Loire"},
+        "departement": {"code": "53", "nom": "Mayenne"}
+    }
+    commune_index(laval)
+    monkeypatch.setattr(communes, "fetch", lambda insee: None)
+    db_session.add_all([
+        Inscription(mail='cache1@test.com', _ville_insee='53130'),
+        Inscription(mail='cache2@test.com', _ville_insee='53130', _cache_api_commune={"nom": "Laval"}),
+        Inscription(mail='cache3@test.com', _ville_insee='53130', _cache_api_commune=laval),
+        Inscription(mail='cache4@test.com', _ville_insee='99999'),
+    ])
+    db_session.commit()
+    assert Inscription.query_stale_cache_api_commune().count() == 3
+
+    report = Inscription.refresh_cache_api_commune()
+    assert report['inscriptions'] == 2
+    assert report['communes_non_trouvees'] == ['99999']
+    assert Inscription.query_stale_cache_api_commune().count() == 1
+    db_session.expire_all()
+    assert Inscription.query.filter_by(mail='cache2@test.com').first().region_name == "Pays de la Loire"
+
+def test_generate_csv(db_session):
+    laval = {
+        "nom": "Laval",
+        "codesPostaux": ["53000"],
+        "centre": {"type": "Point", "coordinates": [-0.7597, 48.0609]},
+        "region": {"code": "52", "nom": "Pays de la Loire"},
+        "departement": {"code": "53", "nom": "Mayenne"}
+    }
+    inscriptions = [
+        Inscription(mail=f'csv{i}@test.com', _ville_insee='53130', _cache_api_commune=laval,
+            deplacement=["velo", "tec"], activites=["menage"], population=["allergie_pollens"], enfants="oui")
+        for i in range(3)
+    ] + [Inscription(mail='csv-inactif@test.com', _ville_insee='53130', deactivation_date=date.today())]
+    db_session.add_all(inscriptions)
+    db_session.commit()
+    lines = "".join(Inscription.generate_csv()).splitlines(keepends=True)
+    assert lines[0].startswith("region,ville,")
+    assert sorted(lines[1:]) == sorted(i.csv_line() for i in inscriptions[:3])
+
+def test_geojson(client, db_session, commune_index):
+    laval = {"type": "Point", "coordinates": [-0.7597, 48.0609]}
+    commune_index({"code": "53130", "centre": laval})
+    db_session.add_all([
+        Inscription(mail='geo1@test.com', _ville_insee='53130', _cache_api_commune={"centre": laval}),
+        Inscription(mail='geo2@test.com', _ville_insee='53130'),
+        Inscription(mail='geo-inactif@test.com', _ville_insee='53130', deactivation_date=date.today()),
+    ])
+    db_session.commit()
+
+    response = client.get('/inscription/geojson')
+    assert response.status_code == 200
+    assert response.json["features"] == [
+        {"type": "Feature", "properties": {"count": 2}, "geometry": laval}
+    ]
+    etag = response.headers['ETag']
+    assert client.get('/inscription/geojson', headers={"If-None-Match": etag}).status_code == 304
+
+    db_session.add(Inscription(mail='geo3@test.com', _ville_insee='53130'))
+    db_session.commit()
+    response = client.get('/inscription/geojson', headers={"If-None-Match": etag})
+    assert response.status_code == 200
+    assert response.json["features"][0]["properties"]["count"] == 3
+
+
+def test_uid_unique(db_session):
+    from sqlalchemy.exc import IntegrityError
+    inscriptions = [Inscription(mail=f'uid-{i}@test.com') for i in range(50)]
+    db_session.add_all(inscriptions)
+    db_session.commit()
+    assert len({i.uid for i in inscriptions}) == 50
+    assert all(len(i.uid) == 8 for i in inscriptions)
+    # Sans verrou consultatif : rien n’est gardé jusqu’à la fin de la transaction
+    assert db_session.execute("SELECT count(*) FROM pg_locks WHERE locktype = 'advisory'").scalar() == 0
+
+    db_session.add(Inscription(mail='uid-doublon@test.com', uid=inscriptions[0].uid))
+    with pytest.raises(IntegrityError):
+        db_session.flush()
+
+
+def test_deuxieme_etape_fast_path(client, monkeypatch, commune_index, capture_sql):
+    commune_index(
+        {"code": "53130", "nom": "Laval", "codesPostaux": ["53000"]},
+        {"code": "38185", "nom": "Grenoble", "codesPostaux": ["38000"]}
+    )
+    def no_http(*args, **kwargs):
+        raise AssertionError("Appel à geo.api.gouv.fr")
+    monkeypatch.setattr(communes.requests, "get", no_http)
+    _mail, uid = premiere_etape(client)
+
+    with capture_sql() as statements:
+        response = client.post(f'/inscription/{uid}/', json={'ville_insee': '53130', 'activites': ['jardinage']})
+        assert response.status_code == 200
+        assert response.json['ville_nom'] == 'Laval'
+        assert response.json['activites'] == ['jardinage']
+        updates = [s for s, _ in statements if s.startswith("UPDATE")]
+        assert len(updates) == 1
+        assert "activites" in updates[0] and "deplacement" not in updates[0]
+        # Une seule lecture de l’inscription, pas de relecture après le commit
+        assert len([s for s, _ in statements if s.startswith("SELECT")]) == 1
+
+        statements.clear()
+        response = client.post(f'/inscription/{uid}/', json={'ville_insee': '53130', 'activites': ['jardinage']})
+        assert response.status_code == 200
+        assert not [s for s, _ in statements if s.startswith("UPDATE")]
+
+    # Changement de commune lu dans l’index local, sans appel HTTP
+    assert client.post(f'/inscription/{uid}/', json={'ville_insee': '38185'}).status_code == 200
+
+    assert client.post(f'/inscription/{uid}/', json={'ville_insee': '99999'}).status_code == 400
+    assert Inscription.query.filter_by(uid=uid).first().ville_nom == 'Grenoble'
+
+
+def test_send_success_email(db_session, sib_stub, monkeypatch, commune_index):
+    from ecosante.extensions import celery
+    from ecosante.inscription.tasks.send_success_email import send_success_email, update_contact_attributes
+    from ecosante.newsletter.models import EnvironnementCommune, NewsletterDB, Recommandation
+    from ecosante.newsletter import models as newsletter_models
+    from indice_pollution import today
+    monkeypatch.setitem(celery.conf, "task_always_eager", True)
+    monkeypatch.setitem(celery.conf, "task_eager_propagates", True)
+    commune_index({"code": "53130", "nom": "Laval"})
+    def no_live(*args, **kwargs):
+        raise AssertionError("Appel à indice_pollution")
+    monkeypatch.setattr(newsletter_models, "get_forecast", no_live)
+    monkeypatch.setattr(newsletter_models, "get_episodes", no_live)
+    EnvironnementCommune.save(today(), {"53130": {
+        "forecast": {"data": [{"date": str(today()), "indice": "bon", "label": "Bon", "couleur": "#50F0E6"}]},
+        "episodes": {"data": []},
+        "raep": {"total": 1, "allergenes": {"graminees": 1}}
+    }})
+    inscription = Inscription(mail='bienvenue@test.com', _ville_insee='53130')
+    db_session.add_all([inscription, Recommandation(recommandation="reco", status="published")])
+    db_session.commit()
+    # Les tâches eager retirent la session : l’inscription n’y est plus ensuite
+    inscription_id = inscription.id
+
+    send_success_email(inscription_id)
+    assert sib_stub.contacts == ['bienvenue@test.com']
+    assert len(sib_stub.updates) == 1
+    _mail, body = sib_stub.updates[0]
+    nl = NewsletterDB.query.filter_by(inscription_id=inscription_id).one()
+    assert body['attributes']['QUALITE_AIR'] == 'Bon'
+    assert body['attributes']['SHORT_ID'] == nl.short_id
+    assert [e['to'] for e in sib_stub.emails] == [[{'email': 'bienvenue@test.com'}]]
+
+    # Contact déjà existant
+    send_success_email(inscription_id)
+    assert len(sib_stub.emails) == 2
+
+    # Une mise à jour refusée par SIB est réessayée seule, sans garder
+    # la newsletter de la tentative échouée
+    sib_stub.rate_limited_updates = 1
+    confirmation = {"inscription_id": inscription_id, "debut": 0, "occupation": 0}
+    result = update_contact_attributes.apply(args=(confirmation,), throw=False)
+    assert result.state == 'SUCCESS'
+    assert sib_stub.rate_limited_updates == 0
+    assert result.get()['occupation'] > 0
+    assert NewsletterDB.query.filter_by(inscription_id=inscription_id).count() == 3
+
+
+def test_deactivate_contacts_incremental(db_session, sib_stub, monkeypatch):
+    from ecosante.extensions import celery
+    from ecosante.inscription.models import SyncState
+    from ecosante.newsletter.tasks.import_in_sb import deactivate_contacts
+    monkeypatch.setitem(celery.conf, "task_always_eager", True)
+    db_session.add_all([Inscription(mail=f'blacklist-{i}@test.com') for i in range(3)])
+    db_session.commit()
+    sib_stub.contact_list = [
+        {"email": "blacklist-0@test.com", "emailBlacklisted": True, "modifiedAt": "2021-06-01T10:00:00.000Z"},
+        {"email": "blacklist-1@test.com", "emailBlacklisted": False, "modifiedAt": "2021-06-01T10:00:00.000Z"},
+        {"email": "inconnu@test.com", "emailBlacklisted": True, "modifiedAt": "2021-06-01T10:00:00.000Z"},
+    ]
+
+    # Première synchronisation : tous les contacts sont lus
+    assert deactivate_contacts() == ["blacklist-0@test.com"]
+    assert not 'modifiedSince' in sib_stub.contact_queries[0]
+    synced_at = SyncState.query.get('sib_blacklist').synced_at
+    assert synced_at is not None
+    assert len(sib_stub.emails) == 1
+
+    # Ensuite, seuls les contacts modifiés depuis sont lus
+    sib_stub.contact_list[1].update(emailBlacklisted=True, modifiedAt="2999-01-01T00:00:00.000Z")
+    assert deactivate_contacts() == ["blacklist-1@test.com"]
+    assert sib_stub.contact_queries[-1]['modifiedSince'][0] < synced_at.strftime('%Y-%m-%dT%H:%M:%S')
+    assert deactivate_contacts() == []
+    assert len(sib_stub.emails) == 2
+    assert Inscription.query.filter_by(mail='blacklist-2@test.com').one().is_active
+
+
+def test_user_unsubscription_webhook(client, db_session, sib_stub, monkeypatch):
+    from ecosante.extensions import celery
+    monkeypatch.setitem(celery.conf, "task_always_eager", True)
+    monkeypatch.setenv('CAPABILITY_WEBHOOK_TOKEN', 'webhook')
+    db_session.add_all([Inscription(mail=f'webhook-{i}@test.com') for i in range(3)])
+    db_session.commit()
+
+    response = client.post('/inscription/webhook/user_unsubscription', json={"email": "webhook-0@test.com"})
+    assert response.status_code == 200
+    assert not Inscription.query.filter_by(mail='webhook-0@test.com').one().is_active
+
+    # Lot d’évènements : seuls ceux qui blacklistent le contact désinscrivent
+    response = client.post('/inscription/webhook/user_unsubscription', json=[
+        {"email": "webhook-1@test.com", "event": "hard_bounce"},
+        {"email": "webhook-2@test.com", "event": "opened"},
+        {"email": "inconnu@test.com", "event": "unsubscribed"},
+    ])
+    assert response.status_code == 200
+    assert not Inscription.query.filter_by(mail='webhook-1@test.com').one().is_active
+    assert Inscription.query.filter_by(mail='webhook-2@test.com').one().is_active
+    assert [e['subject'] for e in sib_stub.emails] == [
+        "Désinscription de 1 utilisateurs de la liste de diffusion",
+        "Désinscription de 1 utilisateurs de la liste de diffusion, 1 erreurs",
+    ]
+    assert "inconnu@test.com" in sib_stub.emails[1]['textContent']
+
+
+def test_bulk_unsubscribe(db_session, sib_stub, monkeypatch, capture_sql):
+    from ecosante.extensions import celery
+    monkeypatch.setitem(celery.conf, "task_always_eager", True)
+    deja_desinscrite = Inscription(mail='bulk-deja@test.com', deactivation_date=date.today() - timedelta(days=3))
+    inscriptions = [Inscription(mail=f'bulk-{i}@test.com') for i in range(500)]
+    db_session.add_all(inscriptions + [deja_desinscrite])
+    db_session.commit()
+
+    with capture_sql(db_session.connection()) as statements:
+        desinscrites, inconnues = Inscription.bulk_unsubscribe(
+            [i.mail for i in inscriptions] + ['bulk-deja@test.com', 'bulk-inconnu@test.com']
+        )
+    assert len([s for s, _ in statements if s.startswith('UPDATE inscription')]) == 1
+    assert len(desinscrites) == 500
+    assert inconnues == ['bulk-inconnu@test.com']
+    assert Inscription.active_query().filter(Inscription.mail.like('bulk-%')).count() == 0
+    assert not inscriptions[0].is_active
+    assert deja_desinscrite.deactivation_date == date.today() - timedelta(days=3)
+    # Un seul mail récapitulatif, sans les adresses inconnues
+    assert len(sib_stub.emails) == 1
+    assert sib_stub.emails[0]['subject'] == "Désinscription de 500 utilisateurs de la liste de diffusion"
+
+    # unsubscribe ne désinscrit que l’inscription elle-même
+    doublons = [Inscription(mail='bulk-doublon@test.com') for _ in range(2)]
+    db_session.add_all(doublons)
+    db_session.commit()
+    doublons[0].unsubscribe()
+    assert not doublons[0].is_active
+    assert doublons[1].is_active
+    assert sib_stub.emails[1]['subject'] == "Désinscription de 1 utilisateurs de la liste de diffusion"
+
+    # Les anciennes tâches encore en file passent par le récapitulatif
+    from ecosante.inscription.tasks import send_unsubscribe, send_unsubscribe_error
+    send_unsubscribe('ancienne@test.com')
+    send_unsubscribe('ancienne@test.com', send_mail=False)
+    send_unsubscribe_error('ancienne-inconnue@test.com')
+    assert [e['subject'] for e in sib_stub.emails[2:]] == [
+        "Désinscription de 1 utilisateurs de la liste de diffusion",
+        "Désinscription de 0 utilisateurs de la liste de diffusion, 1 erreurs",
+    ]
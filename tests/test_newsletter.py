@@ -1,5 +1,8 @@
-from ecosante.newsletter.models import Inscription, Newsletter, NewsletterDB, Recommandation
+from ecosante.newsletter.models import Inscription, Newsletter, NewsletterDB, Recommandation, EnvironnementCommune
+from ecosante.newsletter import models as newsletter_models
 from datetime import date, timedelta
+from indice_pollution import today
+from uuid import uuid4
 
 def test_episode_passe(db_session):
     yesterday = date.today() - timedelta(days=1)
@@ -207,4 +210,198 @@ def test_pollens(db_session):
                                     assert (nl.recommandation.type_ == "pollens") == (date_.weekday() in [2, 5])
                                 else:
                                     assert nl.show_raep == True
-                                    assert nl.recommandation.type_ != "pollens"
\ No newline at end of file
+                                    assert nl.recommandation.type_ != "pollens"
+
+def test_import_contacts(sib_stub, monkeypatch):
+    from ecosante.newsletter.tasks.import_in_sb import import_contacts
+    monkeypatch.setenv('SIB_IMPORT_POLL_INTERVAL', '0')
+    contacts = [(f'import-{i}@test.com', {"RECOMMANDATION": f"reco {i}"}) for i in range(2000)]
+    import_contacts(contacts, 1)
+    assert len(sib_stub.imports) == 1
+    assert len(sib_stub.imports[0]['jsonBody']) == len(contacts)
+    assert sib_stub.imports[0]['listIds'] == [1]
+    assert sib_stub.imports[0]['emptyContactsAttributes'] is True
+    assert sib_stub.updates == []
+
+    sib_stub.fail_imports = True
+    import_contacts(contacts[:10], 1)
+    assert sorted(mail for mail, _ in sib_stub.updates) == sorted(mail for mail, _ in contacts[:10])
+
+
+def test_update_contacts(sib_stub, monkeypatch):
+    from ecosante.newsletter.tasks.import_in_sb import update_contacts
+    monkeypatch.setenv('SIB_RATE_LIMIT', '1000')
+    monkeypatch.setenv('SIB_CONCURRENCY', '4')
+    sib_stub.rate_limited_updates = 3
+    contacts = [(f'update-{i}@test.com', {"RECOMMANDATION": f"reco {i}"}) for i in range(200)]
+    assert update_contacts(contacts, 1) == []
+    assert sorted(mail for mail, _ in sib_stub.updates) == sorted(mail for mail, _ in contacts)
+
+
+def test_progress_reporter():
+    from ecosante.utils.progress import ProgressReporter
+    class Task:
+        states = []
+        def update_state(self, state, meta):
+            self.states.append(meta)
+    task = Task()
+    reporter = ProgressReporter(task, 1000, interval=3600, step=10)
+    for i in range(1000):
+        reporter.advance(1, f"Mise à jour des contacts {i}/1000")
+    reporter.report("Terminé", force=True, email_campaign_id=0)
+    assert len(task.states) == 11
+    assert task.states[-1] == {"progress": 100, "details": "Terminé", "email_campaign_id": 0}
+
+
+def test_environnement_commune(db_session, monkeypatch):
+    appels = []
+    def bulk(insee_region, **kwargs):
+        appels.append(sorted(insee_region))
+        return {
+            insee: {
+                "forecast": {"data": [{"date": str(today()), "indice": "bon"}]},
+                "episode": {"data": []},
+                "raep": {"total": 2, "allergenes": {"graminees": 2}}
+            }
+            for insee in insee_region
+        }
+    monkeypatch.setattr(newsletter_models, "bulk", bulk)
+    environnements = EnvironnementCommune.load({"53130": "Pays de la Loire", "75056": "Île-de-France"})
+    assert environnements["53130"].raep["total"] == 2
+    assert environnements["75056"].episodes == {"data": []}
+    EnvironnementCommune.load({"53130": "Pays de la Loire", "44109": "Pays de la Loire"})
+    assert appels == [["53130", "75056"], ["44109"]]
+    EnvironnementCommune.load({"53130": "Pays de la Loire"}, max_age=timedelta(0))
+    assert appels[-1] == ["53130"]
+
+    monkeypatch.setattr(newsletter_models, "get_forecast", lambda insee, date_: {"data": [], "metadata": {}})
+    monkeypatch.setattr(newsletter_models, "get_episodes", lambda insee, date_: {"data": []})
+    monkeypatch.setattr(newsletter_models, "get_raep", lambda insee: {"data": {"total": 0}})
+    assert EnvironnementCommune.get("53130").raep["total"] == 2
+    assert EnvironnementCommune.get("01001").raep == {"total": 0}
+    assert EnvironnementCommune.query.count() == 4
+
+
+def test_sharded_export(app, db_session, sib_stub, monkeypatch, commune_index):
+    from ecosante.newsletter.tasks.import_in_sb import (
+        build_newsletters, build_newsletters_shard, send_and_report, shard_ranges
+    )
+    commune_index(*[
+        {"code": insee, "nom": nom, "region": {"nom": "Pays de la Loire"}, "departement": {"nom": "Mayenne"}}
+        for insee, nom in [("53130", "Laval"), ("53062", "Château-Gontier"), ("53147", "Mayenne")]
+    ])
+    def bulk(insee_region, **kwargs):
+        return {
+            insee: {
+                # Pas de qualité de l’air pour Mayenne
+                "forecast": {"data": [] if insee == "53147" else [{"date": str(today()), "indice": "bon", "label": "Bon"}]},
+                "episode": {"data": []},
+                "raep": {"total": 2, "allergenes": {"graminees": 2}}
+            }
+            for insee in insee_region
+        }
+    monkeypatch.setattr(newsletter_models, "bulk", bulk)
+    # Ni import des contacts ni campagne : seules la liste et les erreurs sont comparées
+    monkeypatch.setitem(app.config, "ENV", "development")
+    db_session.add_all([Recommandation(recommandation=f"reco {i}", status="published") for i in range(5)])
+    db_session.add_all([
+        Inscription(mail=f'shard-{i}@test.com', diffusion='mail', _ville_insee=["53130", "53062", "53147"][i % 3])
+        for i in range(20)
+    ])
+    db_session.commit()
+
+    def run(newsletters):
+        errors = send_and_report.apply(args=([[nl.id for nl in newsletters]],)).get()['errors']
+        return [(nl.inscription.mail, nl.recommandation_id) for nl in newsletters], errors
+
+    seed = str(uuid4())
+    expected, expected_errors = run(build_newsletters(seed, None, [], None))
+    NewsletterDB.query.delete()
+
+    id_ranges = shard_ranges(3)
+    assert len(id_ranges) == 3
+    assert all(hi < lo for (_, hi), (lo, _) in zip(id_ranges, id_ranges[1:]))
+    shards_ids = [build_newsletters_shard(seed, None, [], None, id_range) for id_range in id_ranges]
+    assert all(shards_ids)
+    result = send_and_report.apply(args=(shards_ids,)).get()
+    ids = [id_ for shard_ids in shards_ids for id_ in shard_ids]
+    by_id = {nl.id: nl for nl in NewsletterDB.query}
+    assert [(by_id[id_].inscription.mail, by_id[id_].recommandation_id) for id_ in ids] == expected
+    assert result['errors'] == expected_errors
+    assert len(result['errors']) == 6
+    assert sib_stub.emails[0]['textContent'] == sib_stub.emails[1]['textContent']
+
+    # L’avancement et le résultat sont publiés sous l’id de la tâche coordinatrice
+    states = []
+    monkeypatch.setattr(
+        send_and_report,
+        "update_state",
+        lambda task_id=None, state=None, meta=None: states.append((task_id, state, meta))
+    )
+    result = send_and_report.apply(args=(shards_ids,), kwargs={"coordinator_id": "coordinatrice"}).get()
+    assert {task_id for task_id, _, _ in states} == {"coordinatrice"}
+    assert states[-1] == ("coordinatrice", "SUCCESS", result)
+
+
+def test_bulk_insert(db_session, monkeypatch):
+    recommandation = Recommandation(recommandation="reco", status="published")
+    inscription = Inscription(mail='bulk@test.com', diffusion='mail', _ville_insee='53130')
+    db_session.add_all([recommandation, inscription])
+    db_session.commit()
+    newsletter = Newsletter(inscription, forecast={"data": []}, episodes={"data": []}, raep=0, recommandation_id=recommandation.id)
+    existante = NewsletterDB(newsletter)
+    db_session.add(existante)
+    db_session.commit()
+
+    # Collision dans le lot, puis avec la newsletter existante, puis entre deux tentatives
+    tirages = iter([existante.short_id, existante.short_id, "AAAAAAAA", "AAAAAAAA", "BBBBBBBB"])
+    monkeypatch.setattr(newsletter_models, "random_id", lambda: next(tirages))
+    newsletters = [NewsletterDB(newsletter) for _ in range(2)]
+    ids = NewsletterDB.bulk_insert(newsletters, batch_size=2)
+    db_session.commit()
+    assert sorted(short_id for _, short_id in ids) == ["AAAAAAAA", "BBBBBBBB"]
+    assert {(nl.id, nl.short_id) for nl in NewsletterDB.query.filter(NewsletterDB.id != existante.id)} == set(ids)
+    assert [(nl.id, nl.short_id) for nl in newsletters] == ids
+
+
+def test_newsletter_index_usage(client, db_session, monkeypatch, capture_sql):
+    from ecosante.newsletter.models import NewsletterHistory
+    monkeypatch.setenv("CAPABILITY_ADMIN_TOKEN", "secret")
+    recommandation = Recommandation(recommandation="reco", status="published")
+    inscription = Inscription(mail='index@test.com', diffusion='mail', _ville_insee='53130')
+    db_session.add_all([recommandation, inscription])
+    db_session.commit()
+    nl = NewsletterDB(Newsletter(inscription, forecast={"data": []}, episodes={"data": []}, raep=0, recommandation_id=recommandation.id))
+    nl.avis = "super"
+    nl.appliquee = True
+    db_session.add(nl)
+    db_session.commit()
+
+    def explain(index_name, call):
+        with capture_sql() as statements:
+            call()
+        statements = [
+            (statement, parameters) for statement, parameters in statements
+            if statement.lstrip().startswith("SELECT") and "FROM newsletter" in statement
+        ]
+        assert statements
+        cursor = db_session.connection().connection.cursor()
+        # Sur une table presque vide le planificateur préfère un parcours séquentiel
+        cursor.execute("SET LOCAL enable_seqscan = off")
+        plans = []
+        for statement, parameters in statements:
+            cursor.execute("EXPLAIN " + statement, parameters)
+            plans.append("\n".join(r[0] for r in cursor.fetchall()))
+        cursor.execute("SET LOCAL enable_seqscan = on")
+        assert any(index_name in plan for plan in plans), plans
+        assert not any("Seq Scan on newsletter" in plan for plan in plans), plans
+
+    explain("ix_newsletter_inscription_id_date", lambda: NewsletterHistory.load(Inscription.mail == inscription.mail))
+    explain("ix_newsletter_inscription_id_date", inscription.last_month_newsletters)
+    explain("newsletter_short_id_key", lambda: client.get(f'/newsletter/{nl.short_id}/avis'))
+    explain("ix_newsletter_date_avis", lambda: client.get('/newsletter/secret/avis/liste', follow_redirects=True))
+    explain("ix_newsletter_date_avis", lambda: client.get('/admin/secret', follow_redirects=True))
+    explain(
+        "ix_newsletter_recommandation_id_date_appliquee",
+        lambda: client.get(f'/recommandations/secret/{recommandation.id}/details', follow_redirects=True)
+    )
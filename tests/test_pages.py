@@ -0,0 +1,116 @@
+from ecosante.pages import blueprint as pages_blueprint
+from ecosante.newsletter.models import EnvironnementCommune
+from ecosante.utils.cache import TTLCache, last_time, seconds_until
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, date
+from time import sleep
+
+
+def test_data_cache(client, monkeypatch):
+    appels = []
+    def get(insee, **kwargs):
+        appels.append(insee)
+        return EnvironnementCommune(
+            insee=insee,
+            date=date.today(),
+            forecast={"data": [{"date": str(date.today()), "indice": "bon"}], "metadata": {"region": {"nom": "Pays de la Loire"}}},
+            episodes={"data": []},
+            raep={"total": 1}
+        )
+    monkeypatch.setattr(EnvironnementCommune, "get", get)
+    monkeypatch.setattr(pages_blueprint, "data_cache", TTLCache(3600))
+    response = client.get('/data?insee=53130')
+    assert response.status_code == 200
+    assert response.json["raep"] == {"total": 1}
+    assert response.cache_control.max_age > 0
+    response = client.get('/data?insee=53130', headers={"If-None-Match": response.headers['ETag']})
+    assert response.status_code == 304
+    client.get('/data?insee=44109')
+    assert appels == ["53130", "44109"]
+
+
+def test_cache_coalescing():
+    cache = TTLCache(60)
+    appels = []
+    def compute():
+        appels.append(1)
+        # Laisse le temps aux autres appels d’arriver pendant le calcul
+        sleep(0.2)
+        return "valeur"
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        results = list(executor.map(lambda _: cache.get_or_set("cle", compute), range(8)))
+    assert results == ["valeur"] * 8
+    assert len(appels) == 1
+
+
+def test_seconds_until():
+    now = datetime(2021, 5, 12, 12, 30)
+    assert seconds_until([13, 15], now) == 30*60 + 1
+    assert seconds_until([13, 15], datetime(2021, 5, 12, 16)) == 8*3600 + 1
+    assert last_time([13, 15], now) == datetime(2021, 5, 12)
+    assert last_time([13, 15], datetime(2021, 5, 12, 14)) == datetime(2021, 5, 12, 13)
+
+
+def test_data_publication(client, db_session, monkeypatch):
+    from ecosante.inscription.models import Inscription
+    from ecosante.newsletter import models as newsletter_models
+    appels = []
+    def get_forecast(insee, date_):
+        appels.append(insee)
+        return {"data": [{"date": str(date_), "indice": "moyen"}], "metadata": {}}
+    monkeypatch.setattr(newsletter_models, "get_forecast", get_forecast)
+    monkeypatch.setattr(newsletter_models, "get_episodes", lambda insee, date_: {"data": []})
+    monkeypatch.setattr(newsletter_models, "get_raep", lambda insee: {"data": {"total": 0}})
+    monkeypatch.setattr(pages_blueprint, "data_cache", TTLCache(3600))
+    # Mis à jour il y a peu, mais avant la dernière publication
+    monkeypatch.setattr(pages_blueprint, "last_time", lambda hours: datetime.now())
+    db_session.add(Inscription(mail='data@test.com', _ville_insee='53130'))
+    db_session.commit()
+    EnvironnementCommune.save(date.today(), {"53130": {
+        "forecast": {"data": [{"date": str(date.today()), "indice": "bon"}], "metadata": {}},
+        "episodes": {"data": []},
+        "raep": {"total": 0}
+    }})
+
+    assert client.get('/data?insee=53130').json["forecast"]["indice"] == "moyen"
+    assert EnvironnementCommune.query.get(("53130", date.today())).forecast["data"][0]["indice"] == "moyen"
+    # Pas d’inscrit : l’environnement n’est pas enregistré
+    assert client.get('/data?insee=44109').json["forecast"]["indice"] == "moyen"
+    assert EnvironnementCommune.query.get(("44109", date.today())) is None
+    assert appels == ["53130", "44109"]
+
+
+def test_city_availability(client, monkeypatch, commune_index):
+    from ecosante.pages import availability
+    commune_index(
+        {"code": "53130", "region": {"nom": "Pays de la Loire"}},
+        {"code": "44109", "region": {"nom": "Pays de la Loire"}},
+        {"code": "97411", "region": {"nom": "La Réunion"}},
+    )
+    regions = []
+    def region_availability(region_name):
+        regions.append(region_name)
+        return region_name == "Pays de la Loire"
+    monkeypatch.setattr(availability.AvailabilityIndex, "region_availability", staticmethod(region_availability))
+    appels = []
+    def live_availability(insee):
+        appels.append(insee)
+        return False
+    monkeypatch.setattr(availability, "availability", live_availability)
+    monkeypatch.setattr(availability, "index", availability.AvailabilityIndex())
+    monkeypatch.setenv('CITY_AVAILABILITY_BULK_MAX', '5')
+
+    assert client.get('/city-availability?insee=53130').json == {"availability": True}
+    assert client.get('/city-availability?insee=97411').json == {"availability": False}
+    assert client.get('/city-availability').status_code == 404
+    response = client.post('/city-availability/bulk', json={"insee": ["53130", "44109", "97411", "00000"]})
+    assert response.json == {"availability": {"53130": True, "44109": True, "97411": False, "00000": False}}
+    assert sorted(regions) == ["La Réunion", "Pays de la Loire"]
+
+    # Les codes absents de l’index sont gardés à part, les codes invalides ignorés
+    response = client.post('/city-availability/bulk', json={"insee": ["00000", "2A004", "x" * 1000]})
+    assert response.json == {"availability": {"00000": False, "2A004": False, "x" * 1000: False}}
+    assert appels == ["00000", "2A004"]
+    assert not "00000" in availability.index.availabilities
+    assert client.post('/city-availability/bulk', json={"insee": ["53130"] * 6}).status_code == 400
+    assert client.post('/city-availability/bulk', json={"insee": [{"code": "53130"}]}).status_code == 400
@@ -1,8 +1,9 @@
 from re import A
 from sqlalchemy.sql.operators import notendswith_op
 from ecosante.recommandations.models import Recommandation
+from ecosante.recommandations.matcher import RelevanceMatcher
 from ecosante.inscription.models import Inscription
-from ecosante.newsletter.models import NewsletterDB, Newsletter
+from ecosante.newsletter.models import NewsletterDB, Newsletter, NewsletterHistory
 from ecosante.extensions import db
 from datetime import date, timedelta
 
@@ -292,4 +293,109 @@ def test_get_relevant_last_criteres(db_session):
 def test_min_raep():
     r = Recommandation(type_="pollens", min_raep=4)
     i = Inscription()
-    assert r.is_relevant(i, "bon", [], 0, date.today()) == False
\ No newline at end of file
+    assert r.is_relevant(i, "bon", [], 0, date.today()) == False
+
+def test_history_sort():
+    r1 = Recommandation(id=1)
+    r2 = Recommandation(id=2)
+    r3 = Recommandation(id=3, type_="pollens")
+    r4 = Recommandation(id=4, ordre=0)
+    r5 = Recommandation(id=5)
+    history = NewsletterHistory(last_sent={"sort@test.com": {
+        r5.id: date.today() - timedelta(days=1),
+        r1.id: date.today() - timedelta(days=2),
+    }})
+    assert history.sort([r1, r2, r3, r4, r5], "sort@test.com") == [r4, r3, r2, r1, r5]
+    assert history.sort([r1, r2, r3, r4, r5], "inconnu@test.com") == [r4, r3, r5, r2, r1]
+
+def test_get_relevant_history_batch(db_session):
+    r1 = Recommandation(menage=True)
+    r2 = Recommandation(menage=True, ordre=0)
+    r3 = Recommandation(velo_trott_skate=True)
+    i1 = Inscription(mail="batch1@test.com", activites=["menage"], deplacement=["velo"])
+    i2 = Inscription(mail="batch2@test.com", activites=["menage"], deplacement=["velo"])
+    db_session.add_all([r1, r2, r3, i1, i2])
+    db_session.commit()
+    nl1 = NewsletterDB(Newsletter(
+        i1,
+        forecast={"data": []},
+        episodes={"data": []},
+        recommandations=[r1, r2, r3]
+    ))
+    db_session.add(nl1)
+    db_session.commit()
+
+    history = NewsletterHistory.load(Inscription.mail.in_([i1.mail, i2.mail]))
+    assert history.last_recommandation[i1.mail] == nl1.recommandation
+    assert i2.mail not in history.last_recommandation
+    for i in [i1, i2]:
+        kwargs = dict(forecast={"data": []}, episodes={"data": []}, recommandations=[r1, r2, r3])
+        assert Newsletter(i, history=history, **kwargs).recommandation ==\
+            Newsletter(i, **kwargs).recommandation
+
+
+def test_matcher_equivalence():
+    recommandations = [
+        Recommandation(),
+        *[Recommandation(**{nom: True}) for nom in ['menage', 'bricolage', 'jardinage', 'activite_physique', 'velo_trott_skate', 'transport_en_commun', 'voiture']],
+        Recommandation(enfants=True),
+        Recommandation(personnes_sensibles=True),
+        Recommandation(autres=True),
+        Recommandation(qa_mauvaise=True),
+        Recommandation(qa_bonne=True),
+        Recommandation(qa_bonne=True, qa_mauvaise=True),
+        Recommandation(qa_bonne=False),
+        *[Recommandation(**{polluant: True}) for polluant in ['ozone', 'particules_fines', 'dioxyde_azote', 'dioxyde_soufre']],
+        Recommandation(menage=True, bricolage=True, qa_bonne=True),
+        Recommandation(particules_fines=True, autres=True, enfants=False, dioxyde_azote=True),
+        Recommandation(particules_fines=True, personnes_sensibles=True, dioxyde_azote=True),
+        Recommandation(type_="pollens"),
+        Recommandation(type_="generale"),
+        Recommandation(type_="pollens", min_raep=4),
+        Recommandation(chauffage=[]),
+        Recommandation(chauffage=["bois"]),
+        Recommandation(chauffage=None),
+        Recommandation(hiver=True),
+        Recommandation(ete=True, automne=True),
+        Recommandation(montrer_dans_le_widget=True),
+    ]
+    inscriptions = [
+        None,
+        Inscription(),
+        *[Inscription(activites=[nom]) for nom in ['menage', 'bricolage', 'jardinage', 'sport']],
+        Inscription(activites=["bricolage", "menage"]),
+        *[Inscription(deplacement=[nom]) for nom in ['velo', 'tec', 'voiture']],
+        Inscription(enfants='oui'),
+        Inscription(enfants='non'),
+        Inscription(pathologie_respiratoire=True),
+        Inscription(allergie_pollens=True),
+        Inscription(allergie_pollens=False),
+        Inscription(chauffage=[]),
+        Inscription(chauffage=[""]),
+        Inscription(chauffage=["bois"]),
+        Inscription(chauffage=None),
+    ]
+    qualifs = [None, "bon", "moyen", "degrade", "mauvais", "tres_mauvais", "extrement_mauvais", "inconnu"]
+    polluants_list = [[], ["ozone"], ["particules_fines"], ["ozone", "particules_fines"], ["dioxyde_azote"], ["dioxyde_soufre"]]
+    dates = [date(2021, 1, 1) + timedelta(days=delta) for delta in range(0, 365, 23)]
+    matcher = RelevanceMatcher(recommandations)
+    for r in recommandations:
+        for i in inscriptions:
+            for qualif in qualifs:
+                for polluants in polluants_list:
+                    for raep in [0, 1, 6]:
+                        for date_ in dates:
+                            assert bool(matcher.is_relevant(r, i, qualif, polluants, raep, date_)) ==\
+                                bool(r.is_relevant(i, qualif, polluants, raep, date_)),\
+                                (r, i and i.__dict__, qualif, polluants, raep, date_)
+
+
+def test_matcher_buckets():
+    recommandations = [Recommandation(menage=True), Recommandation(velo_trott_skate=True), Recommandation(ozone=True)]
+    matcher = RelevanceMatcher(recommandations)
+    i1 = Inscription(activites=["menage"])
+    i2 = Inscription(activites=["menage"])
+    assert matcher.eligible(i1, "bon", [], 0, date.today()) == [recommandations[0]]
+    assert matcher.eligible(i2, "bon", [], 0, date.today()) == [recommandations[0]]
+    assert matcher.eligible(i2, "bon", ["ozone"], 0, date.today()) == [recommandations[2]]
+    assert (matcher.bucket_hits, matcher.bucket_misses) == (1, 2)
@@ -0,0 +1,120 @@
+from ecosante.inscription.models import Inscription, SyncState
+from ecosante.avis.models import Avis
+from ecosante.stats.models import StatsJour, StatsDecouverte, CampaignStats
+from datetime import date, datetime, timedelta
+
+
+def test_refresh_stats(client, db_session, sib_stub):
+    today = date.today()
+    hier = today - timedelta(days=1)
+    sib_stub.campaigns = [
+        {
+            "id": 1,
+            "name": str(datetime.combine(hier, datetime.min.time())),
+            "sentDate": f"{hier}T05:10:00.000+02:00",
+            "statistics": {"globalStats": {"delivered": 200, "uniqueViews": 50}}
+        },
+        {
+            "id": 2,
+            "name": "pas une date",
+            "sentDate": f"{hier}T06:10:00.000+02:00",
+            "statistics": {"globalStats": {"delivered": 200, "uniqueViews": 50}}
+        },
+    ]
+    inscriptions = [
+        Inscription(mail='stats1@test.com', _ville_insee='53130', population=["allergie_pollens"]),
+        Inscription(mail='stats2@test.com', _ville_insee='53130', population=["pathologie_respiratoire"]),
+        Inscription(mail='stats3@test.com', _ville_insee='53130'),
+    ]
+    db_session.add_all(inscriptions)
+    db_session.add_all([Avis(mail='stats1@test.com', decouverte=["rappel"], recommandabilite=9)])
+    db_session.commit()
+    inscriptions[0].date_inscription = hier
+    inscriptions[2].deactivation_date = today
+    db_session.commit()
+
+    assert CampaignStats.sync()['campaigns'] == 2
+    report = StatsJour.refresh()
+    assert report['jours'] == 2
+    assert StatsJour.query.get(hier).inscriptions_actives == 1
+    jour = StatsJour.query.get(today)
+    assert (jour.inscriptions, jour.inscriptions_actives, jour.desinscriptions) == (2, 1, 1)
+    assert (jour.allergies, jour.pathologie_respiratoire) == (1, 1)
+    assert StatsJour.query.get(hier).taux_ouverture == 25
+    assert StatsDecouverte.query.get((today, "rappel")).nombre == 1
+    assert StatsJour.refresh()['jours_modifies'] == 0
+
+    response = client.get('/stats/', headers={"Accept": "application/json"})
+    assert response.status_code == 200
+    assert response.json['total_inscriptions'] == 3
+    assert response.json['total_actifs'] == 2
+    assert response.json['total_reponses'] == response.json['total_satisfaits'] == 1
+    assert response.json['ouverture_veille'] == [hier.strftime("%d/%m/%Y"), 25]
+    response = client.get('/stats/', headers={"Accept": "application/json", "If-None-Match": response.headers['ETag']})
+    assert response.status_code == 304
+
+
+def test_refresh_stats_incremental(client, db_session, sib_stub, monkeypatch):
+    from ecosante.extensions import celery
+    monkeypatch.setitem(celery.conf, "task_always_eager", True)
+    today = date.today()
+    il_y_a_un_mois = today - timedelta(days=30)
+    ancienne = Inscription(mail='stats-ancienne@test.com', _ville_insee='53130')
+    sans_date = Inscription(mail='stats-sans-date@test.com', _ville_insee='53130')
+    db_session.add_all([ancienne, sans_date])
+    db_session.commit()
+    ancienne.date_inscription = il_y_a_un_mois
+    sans_date.date_inscription = None
+    db_session.commit()
+
+    # Premier passage : tout est recalculé
+    StatsJour.refresh()
+    assert StatsJour.query.get(il_y_a_un_mois).inscriptions_actives == 1
+    assert SyncState.get('stats_jour').synced_at is not None
+
+    # Les jours antérieurs au dernier passage ne sont plus relus…
+    avis = Avis(mail='stats-ancienne@test.com', recommandabilite=9)
+    db_session.add(avis)
+    db_session.commit()
+    avis.date = il_y_a_un_mois
+    db_session.commit()
+    StatsJour.refresh()
+    assert StatsJour.query.get(il_y_a_un_mois).reponses == 0
+    # …sauf le jour d’inscription de ceux qui se sont désinscrits depuis
+    ancienne.unsubscribe()
+    StatsJour.refresh()
+    jour = StatsJour.query.get(il_y_a_un_mois)
+    assert (jour.inscriptions, jour.inscriptions_actives) == (1, 0)
+    assert StatsJour.query.get(today).desinscriptions == 1
+    assert StatsJour.refresh(full=True)['jours_modifies'] == 1
+    assert StatsJour.query.get(il_y_a_un_mois).reponses == 1
+
+    # Les inscriptions sans date comptent dans les totaux
+    jour = StatsJour.query.get(today)
+    assert (jour.inscriptions_sans_date, jour.inscriptions_actives_sans_date) == (1, 1)
+    response = client.get('/stats/', headers={"Accept": "application/json"})
+    assert response.json['total_inscriptions'] == 2
+    assert response.json['total_actifs'] == 1
+
+
+def test_sync_campaign_stats(db_session, sib_stub):
+    sib_stub.campaigns = [{
+        "id": 1,
+        "name": "2021-05-10 05:00:00",
+        "sentDate": "2021-05-10T05:10:00.000+02:00",
+        "statistics": {"globalStats": {"delivered": 100, "uniqueViews": 10}}
+    }]
+    CampaignStats.sync()
+    sib_stub.campaigns[0]["statistics"]["globalStats"]["uniqueViews"] = 30
+    sib_stub.campaigns.append({
+        "id": 2,
+        "name": "2021-05-11 05:00:00",
+        "sentDate": "2021-05-11T05:10:00.000+02:00",
+        "statistics": {"globalStats": {"delivered": 100, "uniqueViews": 20}}
+    })
+    assert CampaignStats.sync()['campaigns'] == 2
+    # La seconde synchronisation repart de la dernière campagne connue
+    assert sib_stub.campaign_queries[-1]['startDate'][0].startswith("2021-05-07")
+    assert CampaignStats.query.count() == 2
+    assert CampaignStats.query.get(1).unique_views == 30
+    assert CampaignStats.query.get(2).date == date(2021, 5, 11)
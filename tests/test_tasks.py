@@ -0,0 +1,58 @@
+from ecosante.extensions import celery
+from ecosante.tasks.benchmark import benchmark
+from celery.contrib.testing.worker import start_worker
+
+
+def test_celery_redis(celery_redis, app):
+    assert celery.conf.broker_url == celery_redis
+    assert celery.conf.result_backend == celery_redis
+    assert celery.conf.result_expires == 24*3600
+    assert celery.conf.broker_transport_options['max_connections'] == celery.conf.redis_max_connections
+    with start_worker(celery, pool='solo', perform_ping_check=False):
+        report = benchmark(20)
+    assert (report['broker'], report['backend']) == ('redis', 'redis')
+    assert report['latence_mediane'] < 1
+
+
+def test_celery_redis_opt_in(monkeypatch):
+    from ecosante import celery_urls
+    monkeypatch.setenv('REDIS_URL', 'redis://127.0.0.1:6379/0')
+    monkeypatch.delenv('CELERY_PROFILE', raising=False)
+    monkeypatch.delenv('CELERY_BROKER_URL', raising=False)
+    monkeypatch.delenv('CELERY_RESULT_BACKEND', raising=False)
+    assert celery_urls('postgresql://db') == {
+        'CELERY_RESULT_BACKEND': 'db+postgresql://db',
+        'CELERY_BROKER_URL': 'sqla+postgresql://db',
+    }
+    monkeypatch.setenv('CELERY_PROFILE', 'redis')
+    assert set(celery_urls('postgresql://db').values()) == {'redis://127.0.0.1:6379/0'}
+
+
+def test_inscription_patients(db_session, sib_stub, monkeypatch):
+    from ecosante.inscription.models import Inscription
+    from ecosante.tasks.inscriptions_patients import inscription_patients_task
+    monkeypatch.setenv("SIB_TRANSACTIONAL_CHUNK_SIZE", "2")
+    db_session.add(Inscription(mail='deja@test.com'))
+    db_session.commit()
+    emails = ['p1@test.com', 'deja@test.com', 'p2@test.com', 'p1@test.com', 'p3@test.com']
+
+    result = inscription_patients_task.apply(args=("Dr Who", emails)).get()
+    assert result['resultats'] == {
+        'deja@test.com': 'deja_inscrit',
+        'p1@test.com': 'envoye',
+        'p2@test.com': 'envoye',
+        'p3@test.com': 'envoye',
+    }
+    assert [c['email'] for c in sib_stub.imports[0]['jsonBody']] == ['p1@test.com', 'p2@test.com', 'p3@test.com']
+    assert sib_stub.contacts == []
+    assert [[v['to'][0]['email'] for v in e['messageVersions']] for e in sib_stub.emails] == [
+        ['p1@test.com', 'p2@test.com'], ['p3@test.com']
+    ]
+    assert all(e['params'] == {"NOM_MEDECIN": "Dr Who"} for e in sib_stub.emails)
+
+    # Import refusé : les contacts sont créés un par un
+    sib_stub.fail_imports = True
+    sib_stub.contacts.append('p4@test.com')
+    result = inscription_patients_task.apply(args=("Dr Who", ['p4@test.com', 'p5@test.com'])).get()
+    assert result['resultats'] == {'p4@test.com': 'envoye', 'p5@test.com': 'envoye'}
+    assert sib_stub.contacts == ['p4@test.com', 'p5@test.com']